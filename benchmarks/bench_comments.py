@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Benchmark remove_comments against the previous line-based stripper, per
+language, on JS import inputs that used to backtrack, and on a
+pathological minified bundle.
+
+    python benchmarks/bench_comments.py --size-mb 2
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from codecollector.codecollector import remove_comments, strip_comments  # noqa: E402
+
+
+def remove_comments_quadratic(lines, file_extension):
+    """
+    The previous implementation: every removed block comment rebuilds the
+    line and re-runs six str.find calls over it. Kept as the baseline.
+    """
+    in_multiline_comment = False
+    uncommented_lines = []
+    for line in lines:
+        if in_multiline_comment:
+            end_comment = line.find('*/')
+            if end_comment != -1:
+                in_multiline_comment = False
+                line = line[end_comment + 2:]
+            else:
+                continue
+        while True:
+            candidates = []
+            for token in ('/*', '/**', '//', '#', '<!--', '--'):
+                index = line.find(token)
+                if index != -1:
+                    candidates.append((token, index))
+            if not candidates:
+                break
+            comment_type, comment_start = min(candidates, key=lambda x: x[1])
+            if comment_type in ('/*', '/**'):
+                end_comment = line.find('*/', comment_start + 2)
+                if end_comment != -1:
+                    line = line[:comment_start] + line[end_comment + 2:]
+                else:
+                    in_multiline_comment = True
+                    line = line[:comment_start]
+                    break
+            elif comment_type in ('//', '#', '--'):
+                line = line[:comment_start]
+                break
+            elif comment_type == '<!--':
+                end_comment = line.find('-->', comment_start + 4)
+                if end_comment != -1:
+                    line = line[:comment_start] + line[end_comment + 3:]
+                else:
+                    in_multiline_comment = True
+                    line = line[:comment_start]
+                    break
+        if line.strip() != '':
+            uncommented_lines.append(line)
+    return uncommented_lines
+
+
+def minified_bundle(size_bytes):
+    """ 
+    One huge line of minified JavaScript with a short block comment between
+    every few statements, the worst case for rebuilding the line.
+    """
+    unit = 'var a=b+c;if(a>1){f(a)}/*@__PURE__*/'
+    return [unit * (size_bytes // len(unit)) + '\n']
+
+
+LANGUAGE_SAMPLES = {
+    '.py': [
+        'def handler(request, *args):  # entry point\n',
+        '    total = sum(x * 2 for x in range(10))\n',
+        "    return {'status': 200, 'total': total}\n",
+    ],
+    '.java': [
+        '/** Counts down. */\n',
+        'for (int i = n; i > 0; i--) { counter.add(i); } // loop\n',
+        '    private final Map<String, Integer> cache = new HashMap<>();\n',
+    ],
+    '.js': [
+        'const total = items.reduce((a, b) => a + b, 0); // sum\n',
+        '/* istanbul ignore next */ export function f(x) { return x * 2; }\n',
+        '    if (user && user.roles.includes("admin")) { grant(user); }\n',
+    ],
+    '.sq': [
+        '-- Selects active users\n',
+        'SELECT id, name FROM users WHERE active = 1 AND created_at > ?;\n',
+        'INSERT INTO audit(user_id, action) VALUES (?, ?); /* audit */\n',
+    ],
+    '.css': [
+        '/* layout */\n',
+        '#main .header > a:hover { color: #fff; margin: 0 auto; }\n',
+        '.grid { display: grid; grid-template-columns: repeat(3, 1fr); }\n',
+    ],
+    '.html': [
+        '<!-- navigation -->\n',
+        '<nav class="top"><a href="/home">Home</a> <a href="/about">About</a></nav>\n',
+        '<div id="app" data-role="main"><p>Hello, world</p></div>\n',
+    ],
+}
+
+
+def timed(func, *args, repeat=1):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size-mb', type=float, default=0.25,
+                        help='Size of the minified line in MB (default: 0.25)')
+    parser.add_argument('--lines', type=int, default=60000,
+                        help='Lines per language sample (default: 60000)')
+    parser.add_argument('--no-baseline', action='store_true',
+                        help='Skip the quadratic baseline, which takes minutes above 1 MB')
+    args = parser.parse_args()
+
+    print(f"{'language':<9} {'previous':>12} {'lexer':>12}")
+    for extension, sample in LANGUAGE_SAMPLES.items():
+        source = sample * (args.lines // len(sample))
+        old_time, _ = timed(remove_comments_quadratic, source, extension, repeat=3)
+        lexer_time, _ = timed(remove_comments, source, extension, repeat=3)
+        print(f"{extension:<9} {old_time * 1000:9.1f} ms {lexer_time * 1000:9.1f} ms  "
+              f"({old_time / lexer_time:.1f}x)")
+    print()
+
+    # Inputs that made the JS import-statement regex backtrack
+    # super-linearly; times should roughly double with the size.
+    for label, unit in (('import + spaces', None), ('import a lines', 'import a\n'),
+                        ('import { lines', 'import {\n')):
+        timings = []
+        for size in (5000, 10000, 20000):
+            text = 'import ' + ' ' * size + 'x' if unit is None else unit * size
+            elapsed, _ = timed(strip_comments, text, '.js', repeat=3)
+            timings.append(elapsed)
+        print(f"{label:<16} " + ' '.join(f"{t * 1000:8.2f} ms" for t in timings)
+              + f"  (x{timings[-1] / timings[0]:.1f} for 4x input)")
+    print()
+
+    lines = minified_bundle(int(args.size_mb * 1024 * 1024))
+    comments = lines[0].count('/*')
+    new_time, new_result = timed(remove_comments, lines, '.js')
+    print(f"minified line: {len(lines[0]) / 1e6:.1f} MB, {comments} block comments")
+    if args.no_baseline:
+        print(f"linear scan : {new_time * 1000:9.1f} ms")
+        return
+    old_time, old_result = timed(remove_comments_quadratic, lines, '.js')
+    if old_result != new_result:
+        print("ERROR: implementations disagree on the minified bundle", file=sys.stderr)
+        sys.exit(1)
+    print(f"previous    : {old_time * 1000:9.1f} ms")
+    print(f"linear scan : {new_time * 1000:9.1f} ms  ({old_time / new_time:.0f}x)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+Time CompiledIgnoreRules against pathspec on a realistic .gitignore (the
+common Python and Node templates combined) over every file and directory of
+a tree. The differential check against pathspec is in
+tests/test_ignore_engine.py.
+
+    python benchmarks/bench_ignore_engine.py path/to/repo
+"""
+import argparse
+import os
+import sys
+import sysconfig
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import pathspec  # noqa: E402
+
+from codecollector.codecollector import CompiledIgnoreRules, GitIgnorePattern  # noqa: E402
+
+GITIGNORE = """\
+__pycache__/
+*.py[cod]
+*$py.class
+*.so
+.Python
+build/
+develop-eggs/
+dist/
+downloads/
+eggs/
+.eggs/
+lib/
+lib64/
+parts/
+sdist/
+var/
+wheels/
+share/python-wheels/
+*.egg-info/
+.installed.cfg
+*.egg
+MANIFEST
+*.manifest
+*.spec
+pip-log.txt
+pip-delete-this-directory.txt
+htmlcov/
+.tox/
+.nox/
+.coverage
+.coverage.*
+.cache
+nosetests.xml
+coverage.xml
+*.cover
+*.py,cover
+.hypothesis/
+.pytest_cache/
+cover/
+*.mo
+*.pot
+*.log
+local_settings.py
+db.sqlite3
+db.sqlite3-journal
+instance/
+.webassets-cache
+.scrapy
+docs/_build/
+.pybuilder/
+target/
+.ipynb_checkpoints
+profile_default/
+ipython_config.py
+.pdm.toml
+__pypackages__/
+celerybeat-schedule
+celerybeat.pid
+*.sage.py
+.env
+.venv
+env/
+venv/
+ENV/
+env.bak/
+venv.bak/
+.spyderproject
+.spyproject
+.ropeproject
+/site
+.mypy_cache/
+.dmypy.json
+dmypy.json
+.pyre/
+.pytype/
+cython_debug/
+logs
+npm-debug.log*
+yarn-debug.log*
+yarn-error.log*
+lerna-debug.log*
+.pnpm-debug.log*
+report.[0-9]*.[0-9]*.[0-9]*.[0-9]*.json
+pids
+*.pid
+*.seed
+*.pid.lock
+lib-cov
+coverage
+*.lcov
+.nyc_output
+.grunt
+bower_components
+.lock-wscript
+build/Release
+node_modules/
+jspm_packages/
+web_modules/
+*.tsbuildinfo
+.npm
+.eslintcache
+.stylelintcache
+.rpt2_cache/
+.rts2_cache_cjs/
+.node_repl_history
+*.tgz
+.yarn-integrity
+.env.development.local
+.env.test.local
+.env.production.local
+.env.local
+.parcel-cache
+.next
+out
+.nuxt
+.vuepress/dist
+.temp
+.docusaurus
+.serverless/
+.fusebox/
+.dynamodb/
+.tern-port
+.vscode-test
+.yarn/cache
+.yarn/unplugged
+.yarn/build-state.yml
+.yarn/install-state.gz
+.pnp.*
+!.vscode/settings.json
+*.swp
+.DS_Store
+.idea/
+"""
+
+
+def tree_paths(tree):
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(tree):
+        rel = os.path.relpath(dirpath, tree).replace(os.sep, '/')
+        prefix = '' if rel == '.' else rel + '/'
+        paths.extend(prefix + name + '/' for name in dirnames)
+        paths.extend(prefix + name for name in filenames)
+    return paths
+
+
+def timed(match, paths, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = [match(path) for path in paths]
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('tree', nargs='?', default=sysconfig.get_paths()['stdlib'],
+                        help='Directory whose paths are matched (default: the Python standard library)')
+    parser.add_argument('--repeat', type=int, default=3, help='Timing repetitions (default: 3)')
+    args = parser.parse_args()
+
+    paths = tree_paths(args.tree)
+    lines = GITIGNORE.splitlines()
+    print(f"{len(paths)} paths")
+    for count in (10, 40, len(lines)):
+        spec = pathspec.PathSpec.from_lines(GitIgnorePattern, lines[:count])
+        rules = CompiledIgnoreRules(lines[:count])
+        spec_time, expected = timed(spec.match_file, paths, args.repeat)
+        engine_time, actual = timed(rules.match_file, paths, args.repeat)
+        if actual != expected:
+            print("ERROR: CompiledIgnoreRules and pathspec disagree", file=sys.stderr)
+            sys.exit(1)
+        print(f"{count:4} patterns: pathspec {spec_time * 1000:8.1f} ms, "
+              f"engine {engine_time * 1000:8.1f} ms  ({spec_time / engine_time:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
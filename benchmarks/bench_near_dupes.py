@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Time MinHash signatures for --near-dupes with the pure-Python and (if
+installed) NumPy backends, check that both agree, and count the candidate
+comparisons LSH banding leaves out of the n*(n-1)/2 pairs.
+
+    python benchmarks/bench_near_dupes.py --files 300
+"""
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import codecollector.codecollector as cc  # noqa: E402
+
+TEMPLATE = '''\
+class Tenant{n}Config:
+    name = "tenant-{n}"
+    region = "{region}"
+    retries = {retries}
+
+    def endpoint(self, path):
+        return f"https://{{self.name}}.{region}.example.com/{{path}}"
+
+    def limits(self):
+        return {{"requests": {requests}, "burst": {burst}, "timeout": {timeout}}}
+'''
+
+
+def sample_files(count, seed=1):
+    rng = random.Random(seed)
+    texts = []
+    for n in range(count):
+        if n % 3 == 0:
+            # Unrelated contents
+            texts.append(' '.join(f"value_{rng.randrange(10 ** 6)} = {rng.random()}" for _ in range(200)))
+        else:
+            texts.append(TEMPLATE.format(n=n % 7, region=rng.choice(['eu', 'us']), retries=3,
+                                         requests=1000, burst=rng.choice([50, 100]), timeout=30) * 8)
+    return texts
+
+
+def signatures(texts):
+    index = cc.NearDuplicateIndex()
+    started = time.perf_counter()
+    result = [index.signature(text) for text in texts]
+    return time.perf_counter() - started, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--files', type=int, default=300, help='Number of sample files (default: 300)')
+    args = parser.parse_args()
+    texts = sample_files(args.files)
+
+    numpy_module = cc.numpy
+    cc.numpy = None
+    python_time, python_signatures = signatures(texts)
+    cc.numpy = numpy_module
+    print(f"pure Python : {python_time * 1000:8.1f} ms")
+    if numpy_module is not None:
+        numpy_time, numpy_signatures = signatures(texts)
+        if numpy_signatures != python_signatures:
+            print("ERROR: NumPy and pure-Python signatures differ", file=sys.stderr)
+            sys.exit(1)
+        print(f"NumPy       : {numpy_time * 1000:8.1f} ms  ({python_time / numpy_time:.1f}x)")
+    else:
+        print("NumPy       : not installed")
+
+    index = cc.NearDuplicateIndex()
+    compared = collapsed = 0
+    for n, (text, signature) in enumerate(zip(texts, python_signatures)):
+        candidates = set()
+        for bucket, key in zip(index.buckets, index._band_keys(signature)):
+            candidates.update(bucket.get(key, ()))
+        compared += len(candidates)
+        if index.find(signature) is None:
+            index.add(f"file{n}", text, signature)
+        else:
+            collapsed += 1
+    pairs = args.files * (args.files - 1) // 2
+    print(f"{collapsed} of {args.files} files collapsed; {compared} signature comparisons "
+          f"instead of {pairs} pairs")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Compare the traversal engines behind collect_files on a synthetic tree.
+
+    python benchmarks/bench_traversal.py --dirs 2000 --files 20
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from codecollector.codecollector import (  # noqa: E402
+    collect_files,
+    collect_files_os_walk,
+    collect_gitignore_patterns,
+)
+
+EXTENSIONS = ('.kt', '.kts', '.java', '.svelte', '.js', '.ts', '.html', '.css', '.py', '.sq', '.sqm')
+FILE_SUFFIXES = ('.py', '.js', '.txt', '.java', '.log', '.md')
+
+
+def build_tree(root, n_dirs, files_per_dir, fanout=8, nested_patterns=0):
+    """ 
+    Creates n_dirs directories (fanout children each) holding files_per_dir
+    small files with a mix of collected and ignored suffixes. With
+    nested_patterns, every directory also gets a .gitignore of that many
+    patterns, as in large monorepos.
+    """
+    root = Path(root)
+    (root / '.gitignore').write_text('*.log\nbuild/\n', encoding='utf-8')
+    dirs = [root]
+    for i in range(1, n_dirs):
+        parent = dirs[(i - 1) // fanout]
+        d = parent / f'd{i}'
+        d.mkdir()
+        dirs.append(d)
+    for i, d in enumerate(dirs):
+        if nested_patterns and i:
+            lines = [f'gen_{i}_{k}/\n' if k % 2 else f'*.gen{i}_{k}\n' for k in range(nested_patterns)]
+            (d / '.gitignore').write_text(''.join(lines), encoding='utf-8')
+        for j in range(files_per_dir):
+            suffix = FILE_SUFFIXES[(i + j) % len(FILE_SUFFIXES)]
+            (d / f'f{j}{suffix}').write_text('x = 1\n', encoding='utf-8')
+    build = root / 'build'
+    build.mkdir()
+    for j in range(files_per_dir):
+        (build / f'gen{j}.py').write_text('x = 1\n', encoding='utf-8')
+
+
+def best_of(repeat, func, *args):
+    best = None
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--dirs', type=int, default=1000, help='Number of directories (default: 1000)')
+    parser.add_argument('--files', type=int, default=20, help='Files per directory (default: 20)')
+    parser.add_argument('--nested-gitignores', type=int, default=0, metavar='N',
+                        help='Give every directory a .gitignore with N patterns (default: 0)')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per engine, best is reported (default: 5)')
+    parser.add_argument('tree', nargs='?', help='Existing directory to benchmark instead of a synthetic tree')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.tree:
+            root = args.tree
+        else:
+            root = tmp
+            build_tree(root, args.dirs, args.files, nested_patterns=args.nested_gitignores)
+        ignore_spec = collect_gitignore_patterns(root)
+        exclude_dirs = {'build', 'venv'}
+        walk_time, walk_files = best_of(args.repeat, collect_files_os_walk, root, EXTENSIONS, exclude_dirs, ignore_spec)
+        scan_time, scan_files = best_of(args.repeat, collect_files, root, EXTENSIONS, exclude_dirs, ignore_spec)
+        glob_time, _ = best_of(args.repeat, collect_gitignore_patterns, root)
+        single_time, single_files = best_of(args.repeat, collect_files, root, EXTENSIONS, exclude_dirs)
+        cache_file = str(Path(tmp) / 'traversal-cache.json')
+        # Synthetic directories are brand new; age them so the cache trusts their mtimes
+        for directory, _, _ in os.walk(root):
+            os.utime(directory, ns=(0, 0))
+        collect_files(root, EXTENSIONS, exclude_dirs, cache_file=cache_file)
+        cached_time, cached_files = best_of(args.repeat, collect_files, root, EXTENSIONS, exclude_dirs, None, cache_file)
+
+    if walk_files != scan_files or set(walk_files) != set(single_files) or cached_files != single_files:
+        print("ERROR: engines returned different file lists", file=sys.stderr)
+        sys.exit(1)
+    print(f"files collected: {len(scan_files)}")
+    print(f"os.walk : {walk_time * 1000:8.1f} ms")
+    print(f"scandir : {scan_time * 1000:8.1f} ms  ({walk_time / scan_time:.2f}x)")
+    two_pass = glob_time + walk_time
+    print(f"rglob .gitignore + os.walk   : {two_pass * 1000:8.1f} ms")
+    print(f"single pass, scoped matchers : {single_time * 1000:8.1f} ms  ({two_pass / single_time:.2f}x)")
+    print(f"warm traversal cache         : {cached_time * 1000:8.1f} ms  ({two_pass / cached_time:.2f}x)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Measure the --stats overhead of the token estimator and, when tiktoken is
+installed, calibrate its characters-per-token table on a real tree.
+
+    python benchmarks/calibrate_tokens.py path/to/repo > calibration.json
+    codecollector path/to/repo --stats --token-calibration calibration.json
+"""
+import argparse
+import collections
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from codecollector.codecollector import (  # noqa: E402
+    CHARS_PER_TOKEN,
+    collect_files,
+    estimate_tokens,
+    render_file_section,
+    write_output,
+)
+
+EXTENSIONS = ('.kt', '.kts', '.java', '.svelte', '.js', '.ts', '.html', '.css', '.py', '.sq', '.sqm')
+
+
+def timed(func, *args, repeat=1, **kwargs):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(*args, **kwargs)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('tree', help='Directory to collect')
+    parser.add_argument('--encoding', default='cl100k_base',
+                        help='tiktoken encoding to calibrate against (default: cl100k_base)')
+    parser.add_argument('--repeat', type=int, default=3, help='Timing repetitions (default: 3)')
+    args = parser.parse_args()
+
+    files = collect_files(args.tree, EXTENSIONS, {'build', 'venv'})
+    with tempfile.TemporaryDirectory() as tmp:
+        output = os.path.join(tmp, 'codebase.prompt')
+        plain = timed(write_output, files, output, repeat=args.repeat)
+        with_stats = timed(write_output, files, output, stats_file=os.path.join(tmp, 'stats.json'),
+                           repeat=args.repeat)
+    print(f"{len(files)} files: {plain * 1000:.0f} ms, with --stats {with_stats * 1000:.0f} ms "
+          f"({(with_stats / plain - 1) * 100:+.1f}%)", file=sys.stderr)
+
+    try:
+        import tiktoken
+    except ImportError:
+        print("tiktoken is not installed; skipping calibration.", file=sys.stderr)
+        return
+    encoding = tiktoken.get_encoding(args.encoding)
+    chars = collections.Counter()
+    tokens = collections.Counter()
+    estimated = collections.Counter()
+    for file_path in files:
+        section = render_file_section(file_path)
+        ext = file_path.suffix.lower()
+        chars[ext] += len(section)
+        tokens[ext] += len(encoding.encode(section, disallowed_special=()))
+        estimated[ext] += estimate_tokens(section, ext)
+    calibration = {}
+    for ext in sorted(chars):
+        calibration[ext] = round(chars[ext] / max(1, tokens[ext]), 2)
+        error = (estimated[ext] / max(1, tokens[ext]) - 1) * 100
+        print(f"{ext:<8} {tokens[ext]:>10} tokens  {calibration[ext]:.2f} chars/token  "
+              f"(built-in {CHARS_PER_TOKEN.get(ext, CHARS_PER_TOKEN['*']):.2f}: {error:+.1f}%)",
+              file=sys.stderr)
+    calibration['*'] = round(sum(chars.values()) / max(1, sum(tokens.values())), 2)
+    json.dump(calibration, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,79 @@
 #!/usr/bin/env python3
 import os
 import argparse
+import bz2
+import collections
+import concurrent.futures
+import difflib
+import errno
+import functools
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import lzma
 from pathlib import Path
+import queue
+import random
 import re
+import select
+import struct
+import subprocess
+import sys
+import threading
+import time
+import tokenize
+import zlib
 import pathspec
 
+try:
+    from pathspec.patterns.gitignore.spec import GitIgnoreSpecPattern as GitIgnorePattern
+except ImportError:
+    # pathspec < 1.0, where 'gitwildmatch' is the same pattern, not yet deprecated
+    from pathspec.patterns.gitwildmatch import GitWildMatchPattern as GitIgnorePattern
+
+try:
+    import numpy
+except ImportError:
+    # Optional: vectorises MinHash signatures for --near-dupes
+    numpy = None
+
+def read_gitignore_lines(gitignore):
+    """ 
+    Reads a single .gitignore file and returns its patterns as written,
+    without comments and empty lines.
+    """
+    with open(gitignore, 'r', encoding='utf-8') as f:
+        lines = f.read().splitlines()
+    # Remove comments and empty lines in the .gitignore itself
+    return [p for p in lines if p.strip() and not p.strip().startswith('#')]
+
+def read_gitignore_patterns(gitignore, relative_base):
+    """ 
+    Reads a single .gitignore file and returns its patterns rewritten relative
+    to start_dir, where relative_base is the .gitignore's folder relative to
+    start_dir ("" or "." for start_dir itself).
+    """
+    new_patterns = []
+    for p in read_gitignore_lines(gitignore):
+        # If the pattern starts with '/', in .gitignore terms this means
+        # "relative to .gitignore's folder"—so we prepend the subfolder path.
+        if p.startswith('/'):
+            stripped = p.lstrip('/')
+            if relative_base in ("", "."):
+                new_patterns.append(stripped)
+            else:
+                new_patterns.append(f"{relative_base}/{stripped}")
+        else:
+            # Ensure there's no leading '/' to prevent absolute matching
+            p = p.lstrip('/')
+            if relative_base in ("", "."):
+                new_patterns.append(p)
+            else:
+                new_patterns.append(f"{relative_base}/{p}")
+    return new_patterns
+
 def collect_gitignore_patterns(start_dir):
     """ 
     Collects all .gitignore patterns from the directory tree starting at start_dir.
@@ -14,44 +83,624 @@ def collect_gitignore_patterns(start_dir):
     all_patterns = []
     for gitignore in gitignore_files:
         try:
-            with gitignore.open('r', encoding='utf-8') as f:
-                lines = f.read().splitlines()
-            # Remove comments and empty lines in the .gitignore itself
-            patterns = [p for p in lines if p.strip() and not p.strip().startswith('#')]
             # The .gitignore file's parent directory, relative to start_dir
             base_dir = gitignore.parent
             try:
                 relative_base = str(base_dir.relative_to(start_dir)).replace('\\', '/')
             except ValueError:
                 # If base_dir is not relative to start_dir, skip this gitignore
-                print(f"Warning: .gitignore at {gitignore} is not under the start_dir {start_dir}. Skipping.")
+                print(f"Warning: .gitignore at {gitignore} is not under the start_dir {start_dir}. Skipping.", file=sys.stderr)
                 continue
-            new_patterns = []
-            for p in patterns:
-                # If the pattern starts with '/', in .gitignore terms this means
-                # "relative to .gitignore's folder"—so we prepend the subfolder path.
-                if p.startswith('/'):
-                    stripped = p.lstrip('/')
-                    if relative_base in ("", "."):
-                        new_patterns.append(stripped)
-                    else:
-                        new_patterns.append(f"{relative_base}/{stripped}")
-                else:
-                    # Ensure there's no leading '/' to prevent absolute matching
-                    p = p.lstrip('/')
-                    if relative_base in ("", "."):
-                        new_patterns.append(p)
-                    else:
-                        new_patterns.append(f"{relative_base}/{p}")
-            all_patterns.extend(new_patterns)
+            all_patterns.extend(read_gitignore_patterns(gitignore, relative_base))
         except Exception as e:
-            print(f"Warning: Could not read {gitignore}: {e}")
-    return pathspec.PathSpec.from_lines('gitwildmatch', all_patterns)
+            print(f"Warning: Could not read {gitignore}: {e}", file=sys.stderr)
+    return pathspec.PathSpec.from_lines(GitIgnorePattern, all_patterns)
+
+_GLOB_CHARS = frozenset('*?[\\')
 
-def collect_files(start_dir, extensions, exclude_dirs, ignore_spec):
+class CompiledIgnoreRules:
+    """ 
+    The patterns of one .gitignore compiled into a matching engine. Patterns
+    are grouped by shape: exact names and directory-only names are looked up
+    per path component in dicts, '*.ext' patterns per dotted suffix, and all
+    remaining globs are joined into a single alternation regex ordered from
+    the last pattern to the first. Each group reports the highest-numbered
+    pattern that matches, so last-match-wins and '!' negation behave exactly
+    as in pathspec.
+    """
+    __slots__ = ('names', 'dir_names', 'suffixes', 'regex', 'group_rules')
+
+    def __init__(self, lines):
+        to_regex = GitIgnorePattern.pattern_to_regex
+        self.names = {}
+        self.dir_names = {}
+        self.suffixes = {}
+        globs = []
+        for index, line in enumerate(lines):
+            regex, include = to_regex(line)
+            if include is None:
+                continue
+            rule = (index, include)
+            body = line[1:] if line.startswith('!') else line
+            dir_only = body.endswith('/')
+            core = body[:-1] if dir_only else body
+            # Escapes, surrounding whitespace and anything with a '/' keep
+            # pathspec's own regex, as do the special names '.' and '..'.
+            if (core != core.strip() or '/' in core or '\\' in core
+                    or core in ('', '.', '..')):
+                globs.append((rule, re.compile(regex)))
+            elif not _GLOB_CHARS.intersection(core):
+                (self.dir_names if dir_only else self.names)[core] = rule
+            elif (not dir_only and core.startswith('*.')
+                    and not _GLOB_CHARS.intersection(core[1:])):
+                self.suffixes[core[1:]] = rule
+            else:
+                globs.append((rule, re.compile(regex)))
+        self.regex = None
+        self.group_rules = {}
+        if globs:
+            alternatives = []
+            group = 0
+            for rule, compiled in reversed(globs):
+                # Names may repeat across alternatives, and only the
+                # alternative's own group is read, so make them plain groups
+                regex = compiled.pattern
+                for name in compiled.groupindex:
+                    regex = regex.replace(f'(?P<{name}>', '(?:')
+                # pathspec searches, and leaves some regexes unanchored
+                # ('*/' is just '/'), while the alternation is only matched
+                # at the start of the path
+                if not regex.startswith('^'):
+                    regex = f'(?s:.*?){regex}'
+                group += 1
+                self.group_rules[group] = rule
+                alternatives.append(f'({regex})')
+                group += re.compile(regex).groups
+            self.regex = re.compile('|'.join(alternatives))
+
+    def __bool__(self):
+        return bool(self.names or self.dir_names or self.suffixes or self.regex)
+
+    def decide(self, path):
+        """ 
+        Returns True if path is ignored, False if it is re-included by a '!'
+        pattern, or None if no pattern matches. Directories are passed with a
+        trailing '/'.
+        """
+        best = (-1, None)
+        parts = path.split('/')
+        # Every component but the last is followed by '/'; for directory
+        # paths the last element is the empty string after the trailing '/'.
+        last = len(parts) - 1
+        names = self.names
+        dir_names = self.dir_names
+        suffixes = self.suffixes
+        for position, part in enumerate(parts):
+            if not part:
+                continue
+            if names:
+                rule = names.get(part)
+                if rule is not None and rule[0] > best[0]:
+                    best = rule
+            if dir_names and position < last:
+                rule = dir_names.get(part)
+                if rule is not None and rule[0] > best[0]:
+                    best = rule
+            if suffixes:
+                dot = part.find('.')
+                while dot != -1:
+                    rule = suffixes.get(part[dot:])
+                    if rule is not None and rule[0] > best[0]:
+                        best = rule
+                    dot = part.find('.', dot + 1)
+        if self.regex is not None:
+            match = self.regex.match(path)
+            if match is not None:
+                rule = self.group_rules[match.lastindex]
+                if rule[0] > best[0]:
+                    best = rule
+        return best[1]
+
+    def match_file(self, path):
+        """ 
+        Returns True if path is ignored by these rules alone.
+        """
+        return self.decide(path) is True
+
+class ScopedIgnoreMatcher:
+    """ 
+    Stack of per-directory .gitignore matchers. Each frame holds the rules of
+    one .gitignore, compiled as written and matched against paths relative to
+    that .gitignore's folder, so a path is only checked against the patterns
+    of its ancestor directories. Deeper frames take precedence, and within a
+    frame the last matching pattern wins, as in git.
+    """
+    __slots__ = ('frames',)
+
+    def __init__(self, frames=()):
+        self.frames = frames
+
+    def child(self, base_prefix, lines):
+        """ 
+        Returns a matcher with a frame for a .gitignore in the folder whose
+        relative prefix is base_prefix ("" or "sub/dir/") pushed on top.
+        """
+        rules = CompiledIgnoreRules(lines)
+        if not rules:
+            return self
+        return ScopedIgnoreMatcher(self.frames + ((base_prefix, rules),))
+
+    def match_file(self, path):
+        """ 
+        Returns True if path (relative to start_dir, with a trailing '/' for
+        directories) is ignored.
+        """
+        for base_prefix, rules in reversed(self.frames):
+            decision = rules.decide(path[len(base_prefix):])
+            if decision is not None:
+                return decision
+        return False
+
+def collect_files(start_dir, extensions, exclude_dirs, ignore_spec=None, cache_file=None, visited_dirs=None,
+                  sort=False):
     """ 
     Collect files recursively from start_dir if they match the given extensions, 
-    excluding specified directories and gitignored paths.
+    excluding specified directories and gitignored paths. Returns the list
+    produced by iter_files.
+    """
+    return list(iter_files(start_dir, extensions, exclude_dirs, ignore_spec, cache_file, visited_dirs, sort))
+
+def iter_files(start_dir, extensions, exclude_dirs, ignore_spec=None, cache_file=None, visited_dirs=None,
+               sort=False):
+    """ 
+    Yields the files below start_dir that match the given extensions,
+    excluding specified directories and gitignored paths, as the walk finds
+    them. Only the directory stack is held in memory, so consumers can start
+    writing before the tree has been walked.
+
+    Built on os.scandir: relative paths are carried down as plain strings and
+    DirEntry type information is reused, so no Path objects or extra stat calls
+    are made for entries that are not collected. Yields files in the same
+    order as collect_files_os_walk, or, with sort, with the entries of every
+    directory in name order (files of a directory before its subdirectories).
+
+    When ignore_spec is None the tree is walked only once: each directory's
+    .gitignore is read when the walk enters that directory and pushed onto a
+    ScopedIgnoreMatcher for the subtree below it, and excluded or ignored
+    directories are never opened.
+
+    With cache_file (only used when ignore_spec is None), the result of each
+    directory is stored on disk together with its mtime once the walk has
+    finished. On the next run a directory whose mtime, own .gitignore and
+    ancestor .gitignore files are unchanged is replayed from the cache with a
+    single stat instead of a scandir and ignore matching.
+
+    If visited_dirs is a list, every directory the walk enters is appended to it.
+    """
+    start_dir = os.fspath(Path(start_dir).resolve())
+    discover = ignore_spec is None
+    if discover:
+        ignore_spec = ScopedIgnoreMatcher()
+    else:
+        cache_file = None
+    cache_key = [start_dir, sorted(extensions), sorted(exclude_dirs)]
+    cached_dirs = _load_traversal_cache(cache_file, cache_key) if cache_file else {}
+    new_dirs = {}
+    # Directories changed within this window may change again without a
+    # visible mtime change (coarse timestamps), so they are not cached.
+    trusted_before = time.time_ns() - _CACHE_MTIME_SLACK_NS if cache_file else None
+    # Explicit stack of (absolute dir, relative prefix, spec, ignore chain)
+    # gives the same pre-order as os.walk without hitting the recursion
+    # limit on deep trees. The ignore chain identifies the ancestor
+    # .gitignore files (and their stats) that apply to the directory.
+    stack = [(start_dir, '', ignore_spec, '')]
+    while stack:
+        abs_dir, rel_prefix, spec, chain = stack.pop()
+        if visited_dirs is not None:
+            visited_dirs.append(abs_dir)
+        if cache_file:
+            try:
+                dir_mtime = os.stat(abs_dir).st_mtime_ns
+            except OSError:
+                continue
+            record = cached_dirs.get(rel_prefix)
+            if record is not None and record[0] == dir_mtime and record[1] == chain:
+                gitignore_stat = record[2]
+                if gitignore_stat is None or _stat_signature(os.path.join(abs_dir, '.gitignore')) == gitignore_stat:
+                    new_dirs[rel_prefix] = record
+                    if gitignore_stat is not None:
+                        spec = _PendingGitignore(spec, os.path.join(abs_dir, '.gitignore'), rel_prefix)
+                        chain = f"{chain}|{rel_prefix}:{gitignore_stat[0]}:{gitignore_stat[1]}"
+                    files, subdir_names = record[3], record[4]
+                    if sort:
+                        files, subdir_names = sorted(files), sorted(subdir_names)
+                    for name in files:
+                        yield Path(os.path.join(abs_dir, name))
+                    stack.extend((os.path.join(abs_dir, name), rel_prefix + name + '/', spec, chain)
+                                 for name in reversed(subdir_names))
+                    continue
+        try:
+            with os.scandir(abs_dir) as it:
+                entries = list(it)
+        except OSError:
+            # os.walk silently skips directories it cannot list
+            continue
+        if sort:
+            entries.sort(key=lambda entry: entry.name)
+        gitignore_stat = None
+        if discover:
+            if isinstance(spec, _PendingGitignore):
+                spec = spec.resolve()
+            spec, gitignore_entry = _push_gitignore(spec, entries, rel_prefix)
+            if cache_file and gitignore_entry is not None:
+                gitignore_stat = _stat_signature(gitignore_entry.path)
+        child_chain = chain
+        if gitignore_stat is not None:
+            child_chain = f"{chain}|{rel_prefix}:{gitignore_stat[0]}:{gitignore_stat[1]}"
+        files = []
+        subdirs = []
+        for entry in entries:
+            name = entry.name
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                if spec.match_file(rel_prefix + name + '/'):
+                    continue
+                if name in exclude_dirs:
+                    continue
+                # Like os.walk, symlinked directories are not followed
+                if not entry.is_symlink():
+                    subdirs.append(entry)
+            elif name.lower().endswith(extensions):
+                # Check if the file is ignored
+                if not spec.match_file(rel_prefix + name):
+                    files.append(name)
+                    yield Path(entry.path)
+        if cache_file and dir_mtime < trusted_before:
+            new_dirs[rel_prefix] = (dir_mtime, chain, gitignore_stat, files, [e.name for e in subdirs])
+        stack.extend((entry.path, rel_prefix + entry.name + '/', spec, child_chain)
+                     for entry in reversed(subdirs))
+    if cache_file:
+        _save_traversal_cache(cache_file, cache_key, new_dirs)
+
+def _push_gitignore(matcher, entries, rel_prefix):
+    """ 
+    Returns (matcher, entry): matcher with the .gitignore among entries pushed
+    on top and that .gitignore's DirEntry, or (matcher, None) unchanged if
+    there is none.
+    """
+    for entry in entries:
+        if entry.name == '.gitignore' and entry.is_file():
+            try:
+                lines = read_gitignore_lines(entry.path)
+            except Exception as e:
+                print(f"Warning: Could not read {entry.path}: {e}", file=sys.stderr)
+                return matcher, entry
+            return matcher.child(rel_prefix, lines), entry
+    return matcher, None
+
+# ----------------------------------------------------------------------------
+# Persistent traversal cache
+# ----------------------------------------------------------------------------
+_CACHE_VERSION = 1
+_CACHE_MTIME_SLACK_NS = 2_000_000_000
+
+class _PendingGitignore:
+    """ 
+    A .gitignore replayed from the traversal cache. It is only read and
+    compiled if some directory below it has to be scanned again.
+    """
+    __slots__ = ('parent', 'path', 'rel_prefix', 'matcher')
+
+    def __init__(self, parent, path, rel_prefix):
+        self.parent = parent
+        self.path = path
+        self.rel_prefix = rel_prefix
+        self.matcher = None
+
+    def resolve(self):
+        if self.matcher is None:
+            parent = self.parent
+            if isinstance(parent, _PendingGitignore):
+                parent = parent.resolve()
+            try:
+                self.matcher = parent.child(self.rel_prefix, read_gitignore_lines(self.path))
+            except Exception as e:
+                print(f"Warning: Could not read {self.path}: {e}", file=sys.stderr)
+                self.matcher = parent
+        return self.matcher
+
+def default_cache_file(start_dir):
+    """ 
+    Returns the traversal cache location for start_dir under
+    $XDG_CACHE_HOME/codecollector (~/.cache/codecollector by default).
+    """
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    digest = hashlib.sha1(os.fsencode(Path(start_dir).resolve())).hexdigest()
+    return os.path.join(cache_home, 'codecollector', f'{digest}.json')
+
+def _stat_signature(path):
+    """ 
+    Returns [mtime_ns, size] for path, or None if it cannot be stat'ed.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+def _load_traversal_cache(cache_file, cache_key):
+    """ 
+    Loads the per-directory records of a traversal cache written for the same
+    start_dir, extensions and excluded directories; anything else (missing,
+    corrupt or stale cache) yields an empty cache.
+    """
+    try:
+        with open(cache_file, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        print(f"Warning: Ignoring unreadable traversal cache {cache_file}: {e}", file=sys.stderr)
+        return {}
+    if not isinstance(data, dict) or data.get('version') != _CACHE_VERSION or data.get('key') != cache_key:
+        return {}
+    return data.get('dirs', {})
+
+def _save_traversal_cache(cache_file, cache_key, dirs):
+    """ 
+    Atomically writes the traversal cache so an interrupted run never leaves
+    a truncated file behind.
+    """
+    data = {'version': _CACHE_VERSION, 'key': cache_key, 'dirs': dirs}
+    tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        print(f"Warning: Could not write traversal cache {cache_file}: {e}", file=sys.stderr)
+
+# ----------------------------------------------------------------------------
+# Git index fast path
+# ----------------------------------------------------------------------------
+_INDEX_HEADER = struct.Struct('>4sLL')
+_GITLINK_MODE = 0o160000
+_INDEX_EXTENDED = 0x4000
+_INDEX_SKIP_WORKTREE = 0x4000
+
+def find_git_repository(start_dir):
+    """ 
+    Returns (work_tree, git_dir) for the git work tree containing start_dir,
+    or None when start_dir is not inside one. Handles '.git' files written for
+    worktrees and submodules ("gitdir: <path>").
+    """
+    current = Path(start_dir).resolve()
+    for candidate in (current, *current.parents):
+        dot_git = candidate / '.git'
+        if dot_git.is_dir():
+            return candidate, dot_git
+        if dot_git.is_file():
+            try:
+                content = dot_git.read_text(encoding='utf-8').strip()
+            except OSError:
+                return None
+            if content.startswith('gitdir:'):
+                git_dir = Path(content[len('gitdir:'):].strip())
+                if not git_dir.is_absolute():
+                    git_dir = candidate / git_dir
+                return candidate, git_dir.resolve()
+            return None
+    return None
+
+def _git_hash_size(git_dir):
+    """ 
+    Returns the object id size used by the repository: 32 bytes for sha256
+    repositories, 20 for sha1.
+    """
+    try:
+        config = (Path(git_dir) / 'config').read_text(encoding='utf-8', errors='replace')
+    except OSError:
+        return 20
+    if re.search(r'^\s*objectformat\s*=\s*sha256\s*$', config, re.IGNORECASE | re.MULTILINE):
+        return 32
+    return 20
+
+class _ChunkReader:
+    """ 
+    Minimal buffered reader over a binary file that supports fixed-size and
+    NUL-terminated reads without pulling the whole file into memory.
+    """
+    __slots__ = ('file', 'buffer', 'pos', 'chunk_size')
+
+    def __init__(self, file, chunk_size=1 << 16):
+        self.file = file
+        self.buffer = b''
+        self.pos = 0
+        self.chunk_size = chunk_size
+
+    def _fill(self, needed):
+        # Keep the unread tail and append chunks until `needed` bytes are buffered
+        parts = [self.buffer[self.pos:]]
+        available = len(parts[0])
+        while available < needed:
+            chunk = self.file.read(max(self.chunk_size, needed - available))
+            if not chunk:
+                raise ValueError("unexpected end of git index")
+            parts.append(chunk)
+            available += len(chunk)
+        self.buffer = b''.join(parts)
+        self.pos = 0
+
+    def read(self, size):
+        if len(self.buffer) - self.pos < size:
+            self._fill(size)
+        data = self.buffer[self.pos:self.pos + size]
+        self.pos += size
+        return data
+
+    def read_until_nul(self):
+        end = self.buffer.find(b'\0', self.pos)
+        while end == -1:
+            unread = len(self.buffer) - self.pos
+            self._fill(unread + 1)
+            end = self.buffer.find(b'\0', unread)
+        data = self.buffer[self.pos:end]
+        self.pos = end + 1
+        return data
+
+    def read_varint(self):
+        # Offset encoding used by index v4 for the prefix-compression length
+        byte = self.read(1)[0]
+        value = byte & 0x7f
+        while byte & 0x80:
+            byte = self.read(1)[0]
+            value = ((value + 1) << 7) | (byte & 0x7f)
+        return value
+
+def iter_git_index(index_path, hash_size=20):
+    """ 
+    Streams the entries of a git index file (versions 2, 3 and 4) and yields
+    (path, mode, stage, skip_worktree) tuples, with path as a str relative to
+    the work tree root. Extensions after the entries are not read.
+    """
+    # Fixed part: ctime, mtime, dev, ino, mode, uid, gid, size, object id, flags
+    entry_struct = struct.Struct(f'>24xL12x{hash_size}xH')
+    with open(index_path, 'rb') as f:
+        reader = _ChunkReader(f)
+        signature, version, count = _INDEX_HEADER.unpack(reader.read(_INDEX_HEADER.size))
+        if signature != b'DIRC':
+            raise ValueError(f"{index_path} is not a git index file")
+        if version not in (2, 3, 4):
+            raise ValueError(f"unsupported git index version {version}")
+        previous = b''
+        for _ in range(count):
+            mode, flags = entry_struct.unpack(reader.read(entry_struct.size))
+            fixed_size = entry_struct.size
+            extended = 0
+            if version >= 3 and flags & _INDEX_EXTENDED:
+                extended = int.from_bytes(reader.read(2), 'big')
+                fixed_size += 2
+            if version == 4:
+                strip = reader.read_varint()
+                name = previous[:len(previous) - strip] + reader.read_until_nul()
+                previous = name
+            else:
+                name_length = flags & 0xfff
+                if name_length < 0xfff:
+                    name = reader.read(name_length)
+                    padding = 8 - (fixed_size + name_length) % 8
+                    reader.read(padding)
+                else:
+                    name = reader.read_until_nul()
+                    # read_until_nul consumed one byte of the 1-8 NUL padding
+                    padding = 8 - (fixed_size + len(name)) % 8
+                    reader.read(padding - 1)
+            yield (os.fsdecode(name), mode, (flags >> 12) & 0x3,
+                   bool(extended & _INDEX_SKIP_WORKTREE))
+
+def collect_files_from_git_index(start_dir, extensions, exclude_dirs, include_untracked=False):
+    """ 
+    Collect files for start_dir from the git index instead of walking the tree.
+    Tracked files come straight from .git/index in index order, without any
+    walk or .gitignore compilation. Finding untracked files needs a full walk,
+    so it is opt-in: with include_untracked, untracked files that are not
+    ignored are appended in walk order. Outside a git work tree, or when the
+    index cannot be read, this falls back to collect_files.
+    """
+    start = Path(start_dir).resolve()
+    repository = find_git_repository(start)
+    if repository is None:
+        return collect_files(start_dir, extensions, exclude_dirs)
+    work_tree, git_dir = repository
+    prefix = start.relative_to(work_tree).as_posix()
+    prefix = '' if prefix == '.' else prefix + '/'
+    collected = []
+    tracked = set()
+    try:
+        for path, mode, stage, skip_worktree in iter_git_index(git_dir / 'index', _git_hash_size(git_dir)):
+            # Skip-worktree entries are not checked out, and gitlinks are
+            # submodule commits, not files.
+            if skip_worktree or mode == _GITLINK_MODE:
+                continue
+            if not path.startswith(prefix):
+                continue
+            rel_path = path[len(prefix):]
+            # Unmerged paths appear once per conflict stage
+            if rel_path in tracked:
+                continue
+            *parents, name = rel_path.split('/')
+            if not name.lower().endswith(extensions):
+                continue
+            if exclude_dirs and not exclude_dirs.isdisjoint(parents):
+                continue
+            tracked.add(rel_path)
+            full_path = start / rel_path
+            # Deleted but not yet staged
+            if os.path.lexists(full_path):
+                collected.append(full_path)
+    except FileNotFoundError:
+        # Fresh repository without an index yet
+        return collect_files(start_dir, extensions, exclude_dirs)
+    except (OSError, ValueError, struct.error) as e:
+        print(f"Warning: Could not read git index in {git_dir}: {e}. Walking the tree instead.", file=sys.stderr)
+        return collect_files(start_dir, extensions, exclude_dirs)
+    if include_untracked:
+        for full_path in collect_files(start, extensions, exclude_dirs):
+            if full_path.relative_to(start).as_posix() not in tracked:
+                collected.append(full_path)
+    return collected
+
+def collect_files_from_git_ls_files(start_dir, extensions, exclude_dirs):
+    """ 
+    Collect files for start_dir by streaming
+    `git ls-files -z --cached --others --exclude-standard` over a pipe, so git's
+    own ignore engine replaces both the walk and the .gitignore matching.
+    Paths are filtered by extension as they arrive. Falls back to
+    collect_files when git is not installed or start_dir is not in a repository.
+    """
+    start = Path(start_dir).resolve()
+    command = ['git', 'ls-files', '-z', '--cached', '--others', '--exclude-standard']
+    try:
+        process = subprocess.Popen(command, cwd=start, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    except OSError:
+        return collect_files(start_dir, extensions, exclude_dirs)
+    collected = []
+    seen = set()
+    pending = b''
+    with process:
+        while True:
+            chunk = process.stdout.read(1 << 16)
+            if not chunk:
+                break
+            *records, pending = (pending + chunk).split(b'\0')
+            for record in records:
+                rel_path = os.fsdecode(record)
+                *parents, name = rel_path.split('/')
+                if not name.lower().endswith(extensions):
+                    continue
+                if exclude_dirs and not exclude_dirs.isdisjoint(parents):
+                    continue
+                # Unmerged paths are listed once per conflict stage
+                if rel_path in seen:
+                    continue
+                seen.add(rel_path)
+                full_path = start / rel_path
+                # --cached also lists tracked files deleted from the work tree
+                if os.path.lexists(full_path):
+                    collected.append(full_path)
+    if process.returncode != 0:
+        # Not a git repository (or git failed before listing anything useful)
+        return collect_files(start_dir, extensions, exclude_dirs)
+    return collected
+
+def collect_files_os_walk(start_dir, extensions, exclude_dirs, ignore_spec):
+    """ 
+    Reference os.walk implementation of collect_files, kept for benchmarking
+    and for checking that the scandir engine returns identical results.
     """
     collected = []
     start_dir = Path(start_dir).resolve()
@@ -76,143 +725,1527 @@ def collect_files(start_dir, extensions, exclude_dirs, ignore_spec):
     return collected
 
 # ----------------------------------------------------------------------------
-# 1. Helper: Identify import lines
+# 1. Helper: Remove comments (supports multi-line comments)
 # ----------------------------------------------------------------------------
-def is_import_line(line, file_extension):
-    """ 
-    Determines if a line is an import statement based on the file extension.
-    Excluded lines are not written to the output file.
-    """
-    import_patterns = {
-        '.kt': re.compile(r'^\s*import\s+[\w.]+'),
-        '.kts': re.compile(r'^\s*import\s+[\w.]+'),
-        '.java': re.compile(r'^\s*import\s+[\w.]+;'),
-        '.js': re.compile(r'^\s*import\s+.*\s+from\s+.*;?'),
-        '.ts': re.compile(r'^\s*import\s+.*\s+from\s+.*;?'),
-        '.svelte': re.compile(r'<script[^>]*>\s*import\s+.*\s+from\s+.*;\s*</script>')
-        # Add more patterns if needed
-    }
-    pattern = import_patterns.get(file_extension, None)
-    if pattern:
-        return bool(pattern.match(line))
-    return False
+# Lexer tables per language family: literal rules as (opening character,
+# regex), plus line comment markers and (start, end) block comment pairs.
+# Literals are copied through untouched, so comment delimiters inside them
+# are not mistaken for comments. Unterminated single-line literals stop at
+# the end of the line.
+_DOUBLE_QUOTED = ('"', r'"(?:[^"\\\n]|\\[\s\S])*"?')
+_SINGLE_QUOTED = ("'", r"'(?:[^'\\\n]|\\[\s\S])*'?")
+# Template literals may span lines; ${...} is treated as literal text
+_TEMPLATE_LITERAL = ('`', r'`(?:[^`\\]|\\[\s\S])*`?')
+
+# Whole statements dropped in the lexing pass, as (leading keyword, regex).
+# Each regex starts at the beginning of a line. Only the braces of a named
+# import list and the whitespace before 'from' may span lines, so
+# multi-line 'import {\n a,\n b\n} from "x"' blocks match while a clause
+# never runs on into the following statements. Every piece of the clause
+# starts with a distinct character and the brace list cannot contain '{',
+# so a failed match backtracks in linear time.
+_JS_MODULE = r'''(?:'[^'\n]*'|"[^"\n]*")[^\S\n]*;?[^\S\n]*\n?'''
+_JS_NAMED = r'\{(?:[^{}/]|//[^\n]*\n|/\*(?:[^*]|\*(?!/))*\*/)*\}'
+_JS_NAMESPACE = r'\*[^\S\n]*as[^\S\n]+[\w$]+'
+_JS_CLAUSE = (rf'(?:type[^\S\n]+)?(?:{_JS_NAMED}|{_JS_NAMESPACE}'
+              rf'|[\w$]+(?:[^\S\n]*,[^\S\n]*(?:{_JS_NAMED}|{_JS_NAMESPACE}))?)')
+_JS_IMPORT_STATEMENTS = (
+    # import x from 'y', import {a, b} from 'y', import * as ns from 'y', import 'y'
+    ('import', rf'^[^\S\n]*import(?![\w$])[^\S\n]*(?:{_JS_CLAUSE}\s*from[^\S\n]*)?{_JS_MODULE}'),
+    # export {a} from 'y', export * from 'y', export * as ns from 'y'
+    ('export', rf'^[^\S\n]*export[^\S\n]+(?:type[^\S\n]+)?(?:\*(?:\s+as\s+[\w$]+)?|\{{[^{{}}]*\}})\s*from\s*{_JS_MODULE}'),
+)
+
+# Python import statements: 'import a.b as c, d', 'from .m import (\n a,\n b)'
+# with comments inside the parentheses, and backslash continuations. Each
+# character of the name list is matched by exactly one alternative, so a
+# failed match backtracks in linear time. Imports chained with ';' are
+# dropped together; process_source sets a leading BOM aside beforehand.
+_PY_NAMES = r'(?:[\w.,*]|[^\S\n]|\\\n)*'
+_PY_STATEMENT_END = r'(?:;|(?:#[^\n]*)?(?:\n|\Z))'
+_PY_IMPORT_STATEMENTS = (
+    ('import', rf'(?:^|(?<=;))[^\S\n]*import(?=[^\S\n]){_PY_NAMES}{_PY_STATEMENT_END}'),
+    ('from', rf'(?:^|(?<=;))[^\S\n]*from[^\S\n]+[\w.]+[^\S\n]+import'
+             rf'(?:[^\S\n]*\((?:[^()#]|#[^\n]*)*\)[^\S\n]*|(?=[^\S\n]){_PY_NAMES}){_PY_STATEMENT_END}'),
+)
+
+LEXER_RULES = {
+    'c': {
+        'literals': (_DOUBLE_QUOTED, _SINGLE_QUOTED, _TEMPLATE_LITERAL),
+        'line_comments': ('//',),
+        'block_comments': (('/*', '*/'),),
+        'statement_drops': _JS_IMPORT_STATEMENTS,
+    },
+    'jvm': {
+        # Java text blocks and Kotlin raw strings before ordinary strings
+        'literals': (('"', r'"""[\s\S]*?(?:"""|\Z)'), _DOUBLE_QUOTED, _SINGLE_QUOTED),
+        'line_comments': ('//',),
+        'block_comments': (('/*', '*/'),),
+    },
+    'python': {
+        'literals': (
+            ('"', r'"""(?:[^"\\]|\\[\s\S]|"(?!""))*(?:"""|\Z)'),
+            ("'", r"'''(?:[^'\\]|\\[\s\S]|'(?!''))*(?:'''|\Z)"),
+            _DOUBLE_QUOTED,
+            _SINGLE_QUOTED,
+        ),
+        'line_comments': ('#',),
+        'block_comments': (),
+        'statement_drops': _PY_IMPORT_STATEMENTS,
+    },
+    'sql': {
+        # SQL escapes quotes by doubling them, and literals may span lines
+        'literals': (("'", r"'(?:[^']|'')*'?"), ('"', r'"(?:[^"]|"")*"?')),
+        'line_comments': ('--',),
+        'block_comments': (('/*', '*/'),),
+    },
+    'css': {
+        'literals': (_DOUBLE_QUOTED, _SINGLE_QUOTED),
+        'line_comments': (),
+        'block_comments': (('/*', '*/'),),
+    },
+    'markup': {
+        'literals': (),
+        'line_comments': (),
+        'block_comments': (('<!--', '-->'),),
+    },
+    'svelte': {
+        'literals': (_DOUBLE_QUOTED, _SINGLE_QUOTED, _TEMPLATE_LITERAL),
+        'line_comments': ('//',),
+        'block_comments': (('<!--', '-->'), ('/*', '*/')),
+        'statement_drops': _JS_IMPORT_STATEMENTS,
+    },
+    # Unknown extensions: every comment delimiter we know about, no literals
+    'generic': {
+        'literals': (),
+        'line_comments': ('//', '#', '--'),
+        'block_comments': (('<!--', '-->'), ('/*', '*/')),
+    },
+}
+
+COMMENT_GRAMMAR_BY_EXTENSION = {
+    '.py': 'python',
+    '.kt': 'jvm',
+    '.kts': 'jvm',
+    '.java': 'jvm',
+    '.js': 'c',
+    '.ts': 'c',
+    '.svelte': 'svelte',
+    '.css': 'css',
+    '.html': 'markup',
+    '.sq': 'sql',
+    '.sqm': 'sql',
+}
+
+def _compile_lexer(literals, line_comments, block_comments, statement_drops=()):
+    """ 
+    Compiles a lexer table into a single regex that tokenizes a buffer into
+    runs of code (plain characters and literals, captured) and comments (not
+    captured), so re.split drops the comments in one pass without a Python
+    call per token. A block comment spanning lines also captures one newline,
+    which keeps the code before and after it on separate lines.
+
+    Statement drops are tried first at every line start; a code run stops
+    at a newline only when the next line begins with one of their keywords,
+    so the check costs nothing on other lines.
+    """
+    comment_openers = list(line_comments) + [start for start, _ in block_comments]
+    literal_chars = {opener for opener, _ in literals}
+    trigger_chars = sorted({token[0] for token in comment_openers} | literal_chars
+                           | ({'\n'} if statement_drops else set()))
+    code = [f"[^{''.join(re.escape(char) for char in trigger_chars)}]+"] if trigger_chars else ['[\\s\\S]+']
+    for char in trigger_chars:
+        if char in literal_chars:
+            continue
+        if char == '\n':
+            keywords = '|'.join(keyword for keyword, _ in statement_drops)
+            code.append(f'\\n(?![^\\S\\n]*(?:{keywords})\\b)')
+            continue
+        rests = [token[1:] for token in comment_openers if token[0] == char]
+        if '' not in rests:
+            # The character alone, when it does not open a comment (e.g. division)
+            code.append(f"{re.escape(char)}(?!{'|'.join(re.escape(rest) for rest in rests)})")
+    code.extend(pattern for _, pattern in literals)
+    comments = [re.escape(token) + r'[^\n]*' for token in line_comments]
+    for start, end in block_comments:
+        start, end = re.escape(start), re.escape(end)
+        comments.append(f'{start}[^\\n]*?{end}')
+        comments.append(f'{start}[^\\n]*(\\n)[\\s\\S]*?(?:{end}|\\Z)')
+    drops = ''.join(f'{pattern}|' for _, pattern in statement_drops)
+    return re.compile(f"{drops}((?:{'|'.join(code)})+)" + ''.join(f'|{comment}' for comment in comments),
+                      re.MULTILINE)
+
+LEXERS = {family: _compile_lexer(**rules) for family, rules in LEXER_RULES.items()}
+
+def strip_comments(text, file_extension):
+    """ 
+    Removes the comments from a whole file buffer in one linear pass with the
+    lexer of the file's language family (see COMMENT_GRAMMAR_BY_EXTENSION;
+    unknown extensions use every delimiter). String, character and template
+    literals are tracked, so '"http://..."' or "'#fff'" survive intact. Line
+    comments leave their line ending in place, and a block comment that
+    spans lines is replaced by a single newline. For JS, TS and Svelte the
+    same pass also drops import statements and 'export ... from' re-exports,
+    including multi-line ones.
+    """
+    lexer = LEXERS[COMMENT_GRAMMAR_BY_EXTENSION.get(file_extension.lower(), 'generic')]
+    return ''.join(filter(None, lexer.split(text)))
 
-# ----------------------------------------------------------------------------
-# 2. Helper: Remove comments (supports multi-line comments)
-# ----------------------------------------------------------------------------
 def remove_comments(lines, file_extension):
     """
     Removes all comments from the list of lines. Handles single-line and multi-line comments.
     Returns a new list of lines without comments.
+
+    The lines are lexed as one buffer by strip_comments, so only the file's
+    own comment syntax is recognized and literals are left alone; lines left
+    empty are dropped.
     """
-    in_multiline_comment = False
-    uncommented_lines = []
-    for line in lines:
-        original_line = line
-        if in_multiline_comment:
-            end_comment = line.find('*/')
-            if end_comment != -1:
-                in_multiline_comment = False
-                line = line[end_comment + 2:]
-                # Continue processing the rest of the line after '*/'
-            else:
-                # Entire line is within a multi-line comment
+    text = strip_comments(''.join(lines), file_extension)
+    return [line for line in text.splitlines(keepends=True) if line.strip() != '']
+
+# ----------------------------------------------------------------------------
+# 2. Whole-buffer processing
+# ----------------------------------------------------------------------------
+# Line-drop rules per extension, matched at the start of a line in
+# re.MULTILINE mode. '[^\S\n]' is whitespace that cannot run into the next line.
+# JS and TS imports are dropped by the lexer (see _JS_IMPORT_STATEMENTS).
+_KOTLIN_IMPORT = r'[^\S\n]*import[^\S\n]+[\w.]+'
+_PACKAGE = r'[^\S\n]*package(?:[^\S\n]|$)'
+
+LINE_DROP_RULES = {
+    '.kt': (_KOTLIN_IMPORT, _PACKAGE),
+    '.kts': (_KOTLIN_IMPORT, _PACKAGE),
+    '.java': (r'[^\S\n]*import[^\S\n]+[\w.]+;', _PACKAGE),
+    '.svelte': (r'<script[^>]*>[^\S\n]*import[^\S\n]+.*[^\S\n]+from[^\S\n]+.*;[^\S\n]*</script>',),
+}
+_BLANK_LINES = re.compile(r'^[^\S\n]*(?:\n|\Z)', re.MULTILINE)
+
+def _compile_line_rules(rules):
+    return re.compile(f"^(?:{'|'.join(rules)})[^\\n]*(?:\\n|\\Z)", re.MULTILINE)
+
+def compile_line_filters(drop_line_rules=()):
+    """ 
+    Compiles the line-drop rules of every extension (imports, package lines)
+    into a single alternation regex per extension, and each of the user's
+    --drop-line regexes on its own, once per run. User regexes apply to every
+    extension and drop a line if they match anywhere in it; they are compiled
+    separately so their groups and backreferences keep their numbers, and
+    are matched one line at a time (see _drop_matching_lines) so they cannot
+    run into the next line. Returns {extension: (regex or None, user rules)},
+    with the user rules alone under '*' for other extensions. Raises re.error
+    for an invalid user regex.
+    """
+    user_rules = tuple(re.compile(rule, re.MULTILINE) for rule in drop_line_rules)
+    filters = {extension: (_compile_line_rules(rules), user_rules)
+               for extension, rules in LINE_DROP_RULES.items()}
+    if user_rules:
+        filters['*'] = (None, user_rules)
+    return filters
+
+def _drop_matching_lines(text, rules):
+    """ 
+    Removes every line of text in which one of the compiled rules matches.
+    Each search is bounded to its line with pos/endpos, so '$' and '\\s*'
+    stop at the line end.
+    """
+    kept = []
+    start = 0
+    length = len(text)
+    while start < length:
+        end = text.find('\n', start)
+        line_end = length if end == -1 else end
+        next_start = length if end == -1 else end + 1
+        if not any(rule.search(text, start, line_end) for rule in rules):
+            kept.append(text[start:next_start])
+        start = next_start
+    return ''.join(kept)
+
+DEFAULT_LINE_FILTERS = compile_line_filters()
+
+def process_source(text, file_extension, line_filters=None, strip_docstrings=False):
+    """ 
+    Processes a whole file buffer: comments (and JS/TS imports) are
+    stripped by the lexer, then blank lines and the lines LINE_DROP_RULES
+    drops (imports, package lines) are removed with re.MULTILINE
+    substitutions over the full text instead of a Python loop per line.
+    line_filters comes from compile_line_filters (default: the built-in
+    rules only). The python lexer also drops import statements; with
+    strip_docstrings, Python files go through strip_python_source instead,
+    which removes docstrings as well. A leading BOM is set aside and put
+    back, so both see the first line as it is written.
+    """
+    if text.startswith('\ufeff'):
+        return '\ufeff' + process_source(text[1:], file_extension, line_filters, strip_docstrings)
+    if line_filters is None:
+        line_filters = DEFAULT_LINE_FILTERS
+    stripped = None
+    if strip_docstrings and file_extension.lower() == '.py':
+        stripped = strip_python_source(text, strip_docstrings)
+    text = strip_comments(text, file_extension) if stripped is None else stripped
+    text = _BLANK_LINES.sub('', text)
+    line_drops, user_rules = line_filters.get(file_extension, line_filters.get('*', (None, ())))
+    if line_drops is not None:
+        text = line_drops.sub('', text)
+    if user_rules:
+        text = _drop_matching_lines(text, user_rules)
+    return text
+
+# ----------------------------------------------------------------------------
+# 3. Python: imports, comments and docstrings via tokenize
+# ----------------------------------------------------------------------------
+_PY_SKIPPED_TOKENS = (tokenize.NL, tokenize.ENCODING, tokenize.ENDMARKER)
+
+def strip_python_source(text, strip_docstrings=False):
+    """ 
+    Removes comments and import statements (including parenthesized
+    multi-line ones) from Python source in one streaming pass over the
+    tokenize token stream, and optionally module, class and function
+    docstrings. Because the tokenizer knows where strings are, a '#' inside
+    a string is never taken for a comment. Returns None if the source cannot
+    be tokenized, so the caller can fall back to the python lexer.
+
+    Imports are removed exactly where the python lexer removes them: at the
+    start of a line, or after ';' following an import removed from that
+    line; an import after other code on its line is kept.
+
+    This is several times slower than the lexer, so process_source only uses
+    it when docstrings have to be removed. The text must not start with a
+    BOM (process_source sets it aside).
+    """
+    line_offsets = [0]
+    line_offsets.extend(match.end() for match in re.finditer('\n', text))
+    deletions = []
+    statement = []
+    expect_docstring = True  # the module docstring comes first
+    opens_block = False
+    # End of an import removed up to its ';', where a chained import may follow
+    chain_end = None
+
+    def offset(position):
+        row, col = position
+        return line_offsets[row - 1] + col
+
+    def finish_statement(end_token):
+        nonlocal chain_end
+        first = statement[0]
+        start = offset(first.start)
+        line_start = line_offsets[first.start[0] - 1]
+        is_import = first.type == tokenize.NAME and first.string in ('import', 'from')
+        chained = chain_end is not None and not text[chain_end:start].strip()
+        if not text[line_start:start].strip():
+            # Nothing before the statement on its line: take the indentation too
+            start = line_start
+        elif chained:
+            start = chain_end
+        elif is_import:
+            # Code precedes it on its line, which the lexer keeps as well
+            chain_end = None
+            return
+        chain_end = None
+        if is_import:
+            deletions.append((start, offset(end_token.end)))
+            if end_token.string == ';':
+                chain_end = offset(end_token.end)
+        elif (strip_docstrings and expect_docstring
+                and all(token.type == tokenize.STRING for token in statement)):
+            deletions.append((start, offset(end_token.end)))
+
+    try:
+        for token in tokenize.generate_tokens(io.StringIO(text).readline):
+            token_type = token.type
+            if token_type == tokenize.COMMENT:
+                deletions.append((offset(token.start), offset(token.end)))
+            elif token_type in _PY_SKIPPED_TOKENS:
                 continue
-        while True:
-            start_comment = line.find('/*')
-            start_doc_comment = line.find('/**')
-            single_line_comment = line.find('//')
-            hash_comment = line.find('#')
-            html_comment = line.find('<!--')
-            sql_single_dash = line.find('--')
-
-            # Determine the earliest comment start
-            candidates = []
-            if start_comment != -1:
-                candidates.append(('/*', start_comment))
-            if start_doc_comment != -1:
-                candidates.append(('/**', start_doc_comment))
-            if single_line_comment != -1:
-                candidates.append(('//', single_line_comment))
-            if hash_comment != -1:
-                candidates.append(('#', hash_comment))
-            if html_comment != -1:
-                candidates.append(('<!--', html_comment))
-            if sql_single_dash != -1:
-                candidates.append(('--', sql_single_dash))
-
-            if not candidates:
-                break  # No comments in the line
-
-            # Find the first occurring comment
-            comment_type, comment_start = min(candidates, key=lambda x: x[1])
-
-            if comment_type in ('/*', '/**'):
-                end_comment = line.find('*/', comment_start + 2)
-                if end_comment != -1:
-                    # Remove the comment and continue processing
-                    line = line[:comment_start] + line[end_comment + 2:]
-                else:
-                    # Start of multi-line comment with no end on this line
-                    in_multiline_comment = True
-                    line = line[:comment_start]
-                    break  # Exit the while loop
-            elif comment_type in ('//', '#', '--'):
-                # Remove the comment from here to the end of the line
-                line = line[:comment_start]
-                break  # Exit the while loop
-            elif comment_type == '<!--':
-                end_comment = line.find('-->', comment_start + 4)
-                if end_comment != -1:
-                    # Remove the HTML comment and continue processing
-                    line = line[:comment_start] + line[end_comment + 3:]
-                else:
-                    # Start of HTML comment with no end on this line
-                    in_multiline_comment = True
-                    line = line[:comment_start]
-                    break  # Exit the while loop
+            elif token_type == tokenize.INDENT:
+                # First statement of a def/class body may be its docstring
+                expect_docstring = opens_block
+                opens_block = False
+            elif token_type == tokenize.DEDENT:
+                expect_docstring = False
+            elif token_type == tokenize.NEWLINE or (token_type == tokenize.OP and token.string == ';'):
+                if statement:
+                    finish_statement(token)
+                    first = statement[0].string
+                    opens_block = first in ('def', 'class') or (
+                        first == 'async' and len(statement) > 1 and statement[1].string == 'def')
+                    statement = []
+                    expect_docstring = False
+            else:
+                # A one-line def/class has no indented body to look into
+                opens_block = False
+                statement.append(token)
+    except (tokenize.TokenError, SyntaxError):
+        return None
+    if not deletions:
+        return text
+    pieces = []
+    pos = 0
+    for start, end in sorted(deletions):
+        if end <= pos:
+            # Comment inside an import statement that is already removed
+            continue
+        pieces.append(text[pos:max(start, pos)])
+        pos = end
+    pieces.append(text[pos:])
+    return ''.join(pieces)
+
+def read_source(file_path):
+    """ 
+    Reads a file once as a whole string. Returns (text, None), or
+    (None, error) if it could not be read.
+    """
+    try:
+        with file_path.open('r', encoding='utf-8') as infile:
+            return infile.read(), None
+    except Exception as e:
+        return None, e
+
+def format_file_section(file_path, text, error, line_filters=None, strip_docstrings=False):
+    """ 
+    Returns the output section for one file from the result of read_source:
+    its path header followed by the processed contents, or a note if the
+    file could not be read. A DuplicateFile gets a one-line reference to
+    the earlier file instead.
+    """
+    if isinstance(file_path, DuplicateFile):
+        return f"\n\n{file_path}\n\n<!-- Identical to {file_path.original} -->\n"
+    if error is not None:
+        return f"\n\n{file_path}\n\n<!-- Could not read file: {error} -->\n"
+    processed = process_source(text, file_path.suffix, line_filters, strip_docstrings)
+    return f"\n\n{file_path}\n\n{processed}"
+
+def render_file_section(file_path, line_filters=None, strip_docstrings=False):
+    """ 
+    Returns the output section for one file: its path header followed by the
+    processed contents, or a note if the file could not be read. The file is
+    read once as a whole string and processed as a buffer.
+    """
+    if isinstance(file_path, DuplicateFile):
+        return format_file_section(file_path, None, None)
+    text, error = read_source(file_path)
+    return format_file_section(file_path, text, error, line_filters, strip_docstrings)
 
-        # After removing comments, check if the line is not empty
-        if line.strip() != '':
-            uncommented_lines.append(line)
-    return uncommented_lines
+NO_FILES_FOUND = "\n\n[No files found with the specified extensions.]\n"
 
 # ----------------------------------------------------------------------------
-# 3. Helper: Should we remove the entire line (e.g., lines that begin with package)?
+# 4. Parallel processing
 # ----------------------------------------------------------------------------
-def should_remove_entire_line(line, file_extension):
+def _render_batch(batch, line_filters=None, strip_docstrings=False):
+    """ 
+    Worker entry point: renders a batch of files in order.
+    """
+    return [render_file_section(file_path, line_filters, strip_docstrings) for file_path in batch]
+
+def _batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def imap_ordered(executor, func, iterable, window):
     """ 
-    Returns True if the line should be removed entirely (e.g., 'package' lines in .java/.kt).
+    Like executor.map, but keeps at most `window` calls in flight ahead of
+    the consumer instead of submitting the whole iterable up front, and
+    yields results in input order.
     """
-    # We remove lines beginning with 'package' in Kotlin and Java
-    if file_extension in ('.kt', '.kts', '.java'):
-        if re.match(r'^\s*package\s', line):
-            return True
-    return False
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(executor.submit(func, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
 
-def write_output(collected_files, output_file, file_extension_set=set()):
-    with open(output_file, 'w', encoding='utf-8') as outfile:
-        if collected_files:
-            for file_path in collected_files:
-                outfile.write(f"\n\n{file_path}\n\n")
+def iter_prefetched_sources(collected_files, read_ahead, io_threads=8):
+    """ 
+    Yields (file_path, text, error) in the order of collected_files while a
+    pool of io_threads threads reads up to read_ahead files ahead of the
+    consumer, so open/read latency on network filesystems overlaps with
+    processing.
+    """
+    def read(file_path):
+        return (file_path,) + read_source(file_path)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(io_threads, read_ahead))) as executor:
+        yield from imap_ordered(executor, read, collected_files, window=read_ahead)
+
+def iter_rendered_sections(collected_files, line_filters=None, strip_docstrings=False, jobs=1, batch_size=32,
+                           read_ahead=0, io_threads=8, dedupe=False):
+    """ 
+    Yields the output section of every file, in the order of
+    collected_files. With jobs > 1, batches of batch_size paths are rendered
+    by a pool of worker processes; the result is byte-identical to the
+    serial path. Otherwise, read_ahead > 0 prefetches file contents with a
+    thread pool (see iter_prefetched_sources) while the main thread processes.
+
+    With dedupe, files are read and hashed by iter_deduplicated first, and
+    repeats of earlier contents are rendered as a reference without any
+    processing.
+    """
+    if dedupe:
+        records = iter_deduplicated(collected_files, read_ahead or 2 * io_threads, io_threads)
+        if jobs <= 1:
+            for file_path, text, error in records:
+                yield format_file_section(file_path, text, error, line_filters, strip_docstrings)
+            return
+        # Workers read their own files; only the duplicate markers are kept
+        collected_files = (file_path for file_path, text, error in records)
+    if jobs <= 1:
+        if read_ahead > 0:
+            for file_path, text, error in iter_prefetched_sources(collected_files, read_ahead, io_threads):
+                yield format_file_section(file_path, text, error, line_filters, strip_docstrings)
+            return
+        for file_path in collected_files:
+            yield render_file_section(file_path, line_filters, strip_docstrings)
+        return
+    render = functools.partial(_render_batch, line_filters=line_filters, strip_docstrings=strip_docstrings)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        for sections in imap_ordered(executor, render, _batched(collected_files, batch_size), window=jobs * 2):
+            yield from sections
+
+STDOUT = '-'
+_STREAM_CHUNK_SIZE = 1 << 20
+COMPRESSION_BY_SUFFIX = {'.gz': 'gzip', '.bz2': 'bz2', '.xz': 'xz'}
+
+def _open_compressor(raw, compression, level=None):
+    """ 
+    Wraps the binary stream raw in a streaming stdlib compressor.
+    """
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=9 if level is None else level)
+    if compression == 'bz2':
+        return bz2.BZ2File(raw, 'wb', compresslevel=9 if level is None else level)
+    if compression == 'xz':
+        return lzma.LZMAFile(raw, 'wb', preset=level)
+    raise ValueError(f"Unknown compression: {compression}")
+
+class _CompressingWriter:
+    """ 
+    Text writer that encodes to UTF-8 and hands the bytes to a compressor
+    running on its own thread, through a bounded queue. zlib, bz2 and lzma
+    release the GIL while compressing, so compression overlaps with
+    processing instead of adding to it. flush() does not force a compressor
+    flush, which would hurt the ratio; data reaches the output as the
+    compressor fills its blocks.
+    """
+    def __init__(self, raw, compression, level=None, depth=8):
+        self.raw = raw
+        try:
+            self.compressor = _open_compressor(raw, compression, level)
+        except Exception:
+            raw.close()
+            raise
+        self.chunks = queue.Queue(maxsize=depth)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name='compressor', daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            data = self.chunks.get()
+            if data is None:
+                break
+            if self.error is None:
                 try:
-                    with file_path.open('r', encoding='utf-8') as infile:
-                        lines = infile.readlines()
-                    # Remove comments
-                    uncommented = remove_comments(lines, file_path.suffix)
-                    for line in uncommented:
-                        # 1) Remove import lines
-                        if is_import_line(line, file_path.suffix):
-                            continue
-                        # 2) Check if the entire line should be removed (e.g., 'package')
-                        if should_remove_entire_line(line, file_path.suffix):
-                            continue
-                        # 3) Write the processed line
-                        outfile.write(line)
-                except Exception as e:
-                    outfile.write(f"<!-- Could not read file: {e} -->\n")
+                    self.compressor.write(data)
+                except BaseException as e:
+                    # Keep draining so the producer never blocks on a full queue
+                    self.error = e
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    def write(self, text):
+        self._check()
+        if text:
+            self.chunks.put(text.encode('utf-8'))
+
+    def flush(self):
+        self._check()
+
+    def close(self):
+        self.chunks.put(None)
+        self.thread.join()
+        try:
+            if self.error is None:
+                self.compressor.close()
+        finally:
+            self.raw.close()
+        self._check()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self.outfile is not None:
+            # An index for a truncated shard set would pass for a complete one
+            self.outfile.close()
+
+def infer_compression(output_file):
+    """ 
+    Returns the compression implied by the suffix of output_file, or None.
+    """
+    if output_file == STDOUT:
+        return None
+    return COMPRESSION_BY_SUFFIX.get(Path(output_file).suffix.lower())
+
+def open_output(output_file, compression=None, compress_level=None):
+    """ 
+    Opens output_file for writing text. STDOUT ('-') opens a UTF-8 writer on
+    file descriptor 1 that leaves stdout open when it is closed. With
+    compression ('gzip', 'bz2' or 'xz'), the text is compressed on the fly by
+    a _CompressingWriter.
+    """
+    if output_file == STDOUT:
+        sys.stdout.flush()
+        if compression:
+            raw = open(sys.stdout.fileno(), 'wb', closefd=False, buffering=_STREAM_CHUNK_SIZE)
+            return _CompressingWriter(raw, compression, compress_level)
+        return open(sys.stdout.fileno(), 'w', encoding='utf-8', closefd=False,
+                    buffering=_STREAM_CHUNK_SIZE)
+    if compression:
+        return _CompressingWriter(open(output_file, 'wb'), compression, compress_level)
+    return open(output_file, 'w', encoding='utf-8')
+
+def _recording(iterable, record):
+    """ 
+    Yields the items of iterable, appending each one to record as it is taken.
+    """
+    for item in iterable:
+        record.append(item)
+        yield item
+
+def write_output(collected_files, output_file, file_extension_set=set(), line_filters=None,
+                 strip_docstrings=False, jobs=1, read_ahead=0, io_threads=8, compression=None,
+                 compress_level=None, max_bytes=None, max_tokens=None, stats_file=None, chars_per_token=None,
+                 dedupe=False, near_duplicates=None):
+    """ 
+    Writes the section of every file to output_file as it is rendered and
+    returns the number of files written. collected_files may be any
+    iterable, such as the iter_files generator, so writing starts with the
+    first file found and memory is bounded by the in-flight window rather
+    than the size of the tree.
+
+    Sections are gathered into chunks of about _STREAM_CHUNK_SIZE characters,
+    and each chunk is flushed, so a consumer reading from STDOUT receives
+    large writes while collection is still running. compression and
+    compress_level are passed to open_output.
+
+    With max_bytes or max_tokens, the output is split into shards by a
+    ShardWriter instead. With stats_file, the estimated tokens and bytes of
+    every section are counted as it is written (see TokenStats) and saved
+    there; chars_per_token replaces CHARS_PER_TOKEN for both. dedupe is
+    passed to iter_rendered_sections. With near_duplicates, a similarity
+    threshold, files nearly identical to an earlier one are collapsed by a
+    NearDuplicateIndex before they are written.
+    """
+    stats = TokenStats(chars_per_token) if stats_file else None
+    index = NearDuplicateIndex(near_duplicates) if near_duplicates else None
+    if max_bytes or max_tokens:
+        count = _write_shards(collected_files, output_file, line_filters, strip_docstrings, jobs, read_ahead,
+                              io_threads, compression, compress_level, max_bytes, max_tokens, stats,
+                              chars_per_token, dedupe, index)
+        if stats:
+            stats.save(stats_file)
+        return count
+    # Paths taken by the renderer but not yet written; sections come back
+    # in the same order, so this holds only the in-flight window.
+    in_flight = collections.deque()
+    if stats or index:
+        collected_files = _recording(collected_files, in_flight)
+    count = 0
+    with open_output(output_file, compression, compress_level) as outfile:
+        sections = iter_rendered_sections(collected_files, line_filters, strip_docstrings, jobs,
+                                          read_ahead=read_ahead, io_threads=io_threads, dedupe=dedupe)
+        chunk = []
+        chunk_size = 0
+        for section in sections:
+            if stats or index:
+                file_path = in_flight.popleft()
+                if index:
+                    section = index.collapse(file_path, section)
+                if stats:
+                    stats.add(file_path, section)
+            chunk.append(section)
+            chunk_size += len(section)
+            count += 1
+            if chunk_size >= _STREAM_CHUNK_SIZE:
+                outfile.write(''.join(chunk))
+                outfile.flush()
+                chunk = []
+                chunk_size = 0
+        outfile.write(''.join(chunk))
+        if not count:
+            outfile.write(NO_FILES_FOUND)
+    if stats:
+        stats.save(stats_file)
+    return count
+
+def _write_shards(collected_files, output_file, line_filters, strip_docstrings, jobs, read_ahead, io_threads,
+                  compression, compress_level, max_bytes, max_tokens, stats=None, chars_per_token=None,
+                  dedupe=False, index=None):
+    in_flight = collections.deque()
+    count = 0
+    with ShardWriter(output_file, max_bytes, max_tokens, compression, compress_level, chars_per_token) as writer:
+        sections = iter_rendered_sections(_recording(collected_files, in_flight), line_filters,
+                                          strip_docstrings, jobs, read_ahead=read_ahead, io_threads=io_threads,
+                                          dedupe=dedupe)
+        for section in sections:
+            file_path = in_flight.popleft()
+            if index:
+                section = index.collapse(file_path, section)
+            if stats:
+                stats.add(file_path, section)
+            writer.write_section(file_path, section)
+            count += 1
+        if not count:
+            writer.write_section(None, NO_FILES_FOUND)
+    return count
+
+# ----------------------------------------------------------------------------
+# Content deduplication
+# ----------------------------------------------------------------------------
+class DuplicateFile:
+    """ 
+    A collected file whose raw contents are identical to those of an earlier
+    file, original. Behaves as its path for os.fspath, str and suffix.
+    """
+    __slots__ = ('path', 'original')
+
+    def __init__(self, path, original):
+        self.path = path
+        self.original = original
+
+    def __fspath__(self):
+        return os.fspath(self.path)
+
+    def __str__(self):
+        return str(self.path)
+
+    @property
+    def suffix(self):
+        return self.path.suffix
+
+def _read_hashed(file_path):
+    """ 
+    Thread entry point: reads file_path as bytes and returns (digest, data,
+    error). hashlib releases the GIL while hashing, so reads and hashes of
+    several files run in parallel.
+    """
+    try:
+        with open(file_path, 'rb') as infile:
+            data = infile.read()
+    except Exception as e:
+        return None, None, e
+    return hashlib.blake2b(data, digest_size=16).digest(), data, None
+
+def _decode_source(data):
+    """ 
+    Decodes raw file contents the way read_source's text mode does: UTF-8
+    with universal newlines. Returns (text, None) or (None, error).
+    """
+    try:
+        text = data.decode('utf-8')
+    except UnicodeDecodeError as e:
+        return None, e
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    return text, None
+
+def iter_deduplicated(collected_files, window, io_threads=8):
+    """ 
+    Yields (file_path, text, error) for every file in the order of
+    collected_files, like iter_prefetched_sources, while a thread pool reads
+    and hashes up to window files ahead. A file whose bytes were already
+    seen is yielded as a DuplicateFile referring to the first one, with no
+    text, and is never decoded or processed. Only the digests of distinct
+    contents are kept.
+    """
+    seen = {}
+
+    def read(file_path):
+        return (file_path,) + _read_hashed(file_path)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, io_threads)) as executor:
+        for file_path, digest, data, error in imap_ordered(executor, read, collected_files, window=max(1, window)):
+            if error is not None:
+                yield file_path, None, error
+                continue
+            original = seen.setdefault(digest, file_path)
+            if original is not file_path:
+                yield DuplicateFile(file_path, original), None, None
+                continue
+            yield (file_path,) + _decode_source(data)
+
+# ----------------------------------------------------------------------------
+# Near-duplicate detection
+# ----------------------------------------------------------------------------
+_SHINGLE_TOKEN = re.compile(r'\w+|[^\w\s]')
+# Largest prime below 2**32: shingle hashes and the MinHash hash
+# (a * x + b) are taken mod this
+_MINHASH_PRIME = 4294967291
+_SHINGLE_MULTIPLIER = 1000003
+# Chance that a pair at exactly the --near-dupes threshold becomes a candidate
+_LSH_RECALL = 0.99
+
+def _lsh_bands(threshold, num_bins, recall=_LSH_RECALL):
+    """ 
+    Returns the smallest divisor b of num_bins such that two signatures with
+    similarity threshold share at least one of b bands of num_bins // b rows
+    with probability recall, or num_bins if none does.
+    """
+    for bands in range(1, num_bins + 1):
+        if num_bins % bands == 0:
+            rows = num_bins // bands
+            if 1 - (1 - threshold ** rows) ** bands >= recall:
+                return bands
+    return num_bins
+
+class NearDuplicateIndex:
+    """ 
+    Finds files whose processed text is nearly the same as an earlier file's
+    and collapses them to a reference plus a diff.
+
+    Each text becomes a set of hashed shingles (shingle_size consecutive
+    tokens), summarised by a one-permutation MinHash signature: every
+    shingle is hashed once, the hash picks one of num_bins bins, and each
+    bin keeps its minimum; empty bins borrow from the next non-empty bin
+    (rotation densification). That is one hash per shingle instead of one
+    per shingle and permutation. The signature is computed with NumPy when
+    it is installed and in pure Python otherwise, with identical results.
+    Signatures are split into bands for locality-sensitive hashing, so a
+    file is compared only with the earlier representatives that share a
+    band, instead of with every file. Unless given, bands is the smallest
+    that makes a pair at exactly threshold similarity share a band with
+    probability _LSH_RECALL (16 bands of 8 rows at 0.85, 32 of 4 at 0.7).
+    A candidate is a near-duplicate when the estimated Jaccard similarity
+    of the signatures reaches threshold.
+    """
+    def __init__(self, threshold=0.85, num_bins=128, bands=None, shingle_size=5):
+        if bands is None:
+            bands = _lsh_bands(threshold, num_bins)
+        if num_bins % bands:
+            raise ValueError("num_bins must be a multiple of bands")
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self.num_bins = num_bins
+        self.bands = bands
+        self.rows = num_bins // bands
+        # Fixed seed: the same tree always gives the same output
+        rng = random.Random(0x5EED)
+        self.a = rng.randrange(1, _MINHASH_PRIME)
+        self.b = rng.randrange(_MINHASH_PRIME)
+        self.token_hashes = {}
+        self.buckets = [{} for _ in range(bands)]
+        self.signatures = []
+        self.representatives = []
+
+    def _shingles(self, text):
+        token_hashes = self.token_hashes
+        hashes = []
+        for token in _SHINGLE_TOKEN.findall(text):
+            value = token_hashes.get(token)
+            if value is None:
+                value = token_hashes[token] = zlib.crc32(token.encode('utf-8'))
+            hashes.append(value)
+        if not hashes:
+            return ()
+        size = min(self.shingle_size, len(hashes))
+        count = len(hashes) - size + 1
+        # A shingle hashes to sum(token * M**(size - 1 - i)) mod p
+        if numpy is not None:
+            hashes = numpy.array(hashes, dtype=numpy.uint64)
+            shingles = hashes[:count] % _MINHASH_PRIME
+            for offset in range(1, size):
+                shingles = (shingles * _SHINGLE_MULTIPLIER + hashes[offset:offset + count]) % _MINHASH_PRIME
+            return numpy.unique(shingles)
+        # Rolling form of the same polynomial: one step per token
+        top = pow(_SHINGLE_MULTIPLIER, size - 1, _MINHASH_PRIME)
+        value = 0
+        for token_hash in hashes[:size]:
+            value = (value * _SHINGLE_MULTIPLIER + token_hash) % _MINHASH_PRIME
+        shingles = {value}
+        for old, new in zip(hashes, hashes[size:]):
+            value = ((value - old * top) * _SHINGLE_MULTIPLIER + new) % _MINHASH_PRIME
+            shingles.add(value)
+        return shingles
+
+    def signature(self, text):
+        """ 
+        Returns the MinHash signature of text as a tuple, or None if it has
+        no tokens.
+        """
+        shingles = self._shingles(text)
+        if not len(shingles):
+            return None
+        bins = self.num_bins
+        if numpy is not None:
+            # a, x < 2**32, so a * x + b stays below 2**64
+            hashed = (numpy.uint64(self.a) * shingles + numpy.uint64(self.b)) % numpy.uint64(_MINHASH_PRIME)
+            minimum = numpy.full(bins, _MINHASH_PRIME, dtype=numpy.uint64)
+            numpy.minimum.at(minimum, hashed % numpy.uint64(bins), hashed // numpy.uint64(bins))
+            filled = {index: value for index, value in enumerate(minimum.tolist()) if value != _MINHASH_PRIME}
         else:
-            outfile.write("\n\n[No files found with the specified extensions.]\n")
+            a, b = self.a, self.b
+            hashed = sorted(((a * x + b) % _MINHASH_PRIME for x in shingles), reverse=True)
+            # Written largest first, so each bin ends up with its minimum
+            filled = {value % bins: value // bins for value in hashed}
+        if len(filled) == bins:
+            return tuple(filled[index] for index in range(bins))
+        # Borrowing from t bins further adds t * step, above any bin value
+        step = _MINHASH_PRIME // bins + 1
+        signature = []
+        for index in range(bins):
+            distance = 0
+            while (index + distance) % bins not in filled:
+                distance += 1
+            signature.append(filled[(index + distance) % bins] + distance * step)
+        return tuple(signature)
+
+    def _band_keys(self, signature):
+        rows = self.rows
+        return [signature[band * rows:(band + 1) * rows] for band in range(self.bands)]
+
+    def find(self, signature):
+        """ 
+        Returns (representative index, estimated similarity) of the most
+        similar earlier representative at or above the threshold, or None.
+        """
+        candidates = set()
+        for bucket, key in zip(self.buckets, self._band_keys(signature)):
+            candidates.update(bucket.get(key, ()))
+        best = None
+        for candidate in sorted(candidates):
+            other = self.signatures[candidate]
+            similarity = sum(x == y for x, y in zip(signature, other)) / len(signature)
+            if similarity >= self.threshold and (best is None or similarity > best[1]):
+                best = (candidate, similarity)
+        return best
+
+    def add(self, file_path, text, signature):
+        index = len(self.signatures)
+        self.signatures.append(signature)
+        # Kept compressed: representatives are only needed again for diffs
+        self.representatives.append((os.fspath(file_path), zlib.compress(text.encode('utf-8'), 1)))
+        for bucket, key in zip(self.buckets, self._band_keys(signature)):
+            bucket.setdefault(key, []).append(index)
+
+    def collapse(self, file_path, section):
+        """ 
+        Returns section unchanged, or, if its processed text is a
+        near-duplicate of an earlier file's, a section holding a reference
+        to that file and a unified diff against it. A diff that would not
+        be much shorter than the text itself is not used.
+        """
+        header = f"\n\n{file_path}\n\n"
+        if not section.startswith(header):
+            return section
+        text = section[len(header):]
+        # Unreadable files and exact duplicates are notes, not contents
+        if text.startswith('<!-- '):
+            return section
+        signature = self.signature(text)
+        if signature is None:
+            return section
+        match = self.find(signature)
+        if match is not None:
+            original, compressed = self.representatives[match[0]]
+            original_text = zlib.decompress(compressed).decode('utf-8')
+            if original_text == text:
+                reference = f"<!-- Same processed contents as {original} -->\n"
+                if len(reference) < len(text):
+                    return header + reference
+                return section
+            diff = difflib.unified_diff(original_text.splitlines(), text.splitlines(), n=0, lineterm='')
+            diff = '\n'.join(itertools.islice(diff, 2, None)) + '\n'
+            if len(diff) < len(text) // 2:
+                return (f"{header}<!-- Near-duplicate of {original} (~{match[1]:.0%} similar); "
+                        f"unified diff against it: -->\n{diff}")
+        self.add(file_path, text, signature)
+        return section
+
+# ----------------------------------------------------------------------------
+# Token estimation
+# ----------------------------------------------------------------------------
+# Characters per token of processed output, per extension, for BPE
+# tokenizers of the cl100k/o200k kind; '*' covers everything else. Measure
+# your own with benchmarks/calibrate_tokens.py and pass the result with
+# --token-calibration.
+CHARS_PER_TOKEN = {
+    '.kt': 4.0,
+    '.kts': 4.0,
+    '.java': 4.2,
+    '.svelte': 3.5,
+    '.js': 3.6,
+    '.ts': 3.7,
+    '.html': 3.3,
+    '.css': 3.1,
+    '.py': 3.8,
+    '.sq': 3.6,
+    '.sqm': 3.6,
+    '*': 3.8,
+}
+
+def chars_per_token_ratio(file_extension, chars_per_token=None):
+    """ 
+    Returns the characters per token for file_extension from chars_per_token,
+    or from CHARS_PER_TOKEN if no calibrated table is given.
+    """
+    table = CHARS_PER_TOKEN if chars_per_token is None else chars_per_token
+    return table.get(file_extension.lower()) or table['*']
+
+def estimate_tokens(text, file_extension='', chars_per_token=None):
+    """ 
+    Dependency-free estimate of the number of tokens in text, from its length
+    and the chars-per-token ratio of its language. Constant time, so it can
+    run on every section.
+    """
+    return int(-(-len(text) // chars_per_token_ratio(file_extension, chars_per_token)))
+
+def load_token_calibration(calibration_file):
+    """ 
+    Returns CHARS_PER_TOKEN updated with the JSON object in calibration_file,
+    which maps extensions (and optionally '*') to characters per token.
+    """
+    with open(calibration_file, 'r', encoding='utf-8') as f:
+        calibration = json.load(f)
+    if not isinstance(calibration, dict):
+        raise ValueError("expected a JSON object mapping extensions to characters per token")
+    table = dict(CHARS_PER_TOKEN)
+    for ext, ratio in calibration.items():
+        if not isinstance(ratio, (int, float)) or ratio <= 0:
+            raise ValueError(f"characters per token for {ext!r} must be a positive number")
+        if ext != '*' and not ext.startswith('.'):
+            ext = f'.{ext}'
+        table[ext.lower()] = float(ratio)
+    return table
+
+def default_stats_file(output_file):
+    """ 
+    Returns the stats sidecar for output_file: codebase.prompt becomes
+    codebase.stats.json.
+    """
+    path = Path('codebase' if output_file == STDOUT else output_file)
+    if path.suffix.lower() in COMPRESSION_BY_SUFFIX:
+        path = path.with_suffix('')
+    return os.fspath(path.with_name(f"{path.stem}.stats.json"))
+
+class TokenStats:
+    """ 
+    Per-file and total token and byte counts of the written sections,
+    saved as a JSON sidecar.
+    """
+    def __init__(self, chars_per_token=None):
+        self.chars_per_token = CHARS_PER_TOKEN if chars_per_token is None else chars_per_token
+        self.files = []
+        self.total_tokens = 0
+        self.total_bytes = 0
+
+    def add(self, file_path, section):
+        tokens = estimate_tokens(section, file_path.suffix, self.chars_per_token)
+        size = _utf8_size(section)
+        self.files.append({'path': os.fspath(file_path), 'tokens': tokens, 'bytes': size})
+        self.total_tokens += tokens
+        self.total_bytes += size
+
+    def save(self, stats_file):
+        stats = {
+            'estimator': 'chars-per-token',
+            'chars_per_token': self.chars_per_token,
+            'total_files': len(self.files),
+            'total_tokens': self.total_tokens,
+            'total_bytes': self.total_bytes,
+            'files': self.files,
+        }
+        with open(stats_file, 'w', encoding='utf-8') as f:
+            json.dump(stats, f, indent=1)
+            f.write('\n')
+
+# ----------------------------------------------------------------------------
+# Budget packing
+# ----------------------------------------------------------------------------
+# Relative value of a file by extension; anything else counts as 1.0.
+EXTENSION_PRIORITY = {
+    '.kt': 1.0,
+    '.kts': 0.6,
+    '.java': 1.0,
+    '.svelte': 0.9,
+    '.js': 0.9,
+    '.ts': 1.0,
+    '.py': 1.0,
+    '.sq': 0.8,
+    '.sqm': 0.4,
+    '.html': 0.5,
+    '.css': 0.4,
+}
+
+# (pattern on the lower-cased path relative to the start directory, factor)
+_NAME_PRIORITY_RULES = [
+    (re.compile(r'(?:^|/)(?:tests?|spec|__tests__|testing)/|(?:^|[/_.-])(?:test|spec)s?[_.-]|[_.-](?:test|spec)s?\.'), 0.4),
+    (re.compile(r'(?:^|/)(?:mocks?|fixtures?|examples?|samples?)/'), 0.5),
+    (re.compile(r'generated|(?:^|/)(?:gen|dist|vendor|third_party)/|\.min\.|_pb2\.|\.g\.'), 0.1),
+    (re.compile(r'(?:^|/)migrations?/'), 0.3),
+    (re.compile(r'(?:^|/)(?:main|app|index|__init__|settings|config)\.[^/]+$'), 1.3),
+]
+
+# Files above this many bytes are usually generated or data
+_LARGE_FILE_BYTES = 256 * 1024
+_RECENCY_HALF_LIFE_S = 30 * 24 * 3600
+
+def score_file(rel_path, stat, now):
+    """ 
+    Returns the packing priority of a file from cheap signals only: its
+    extension, name patterns (tests, generated code, ...), depth below the
+    start directory, size and how recently it was modified.
+    """
+    path = rel_path.lower()
+    score = EXTENSION_PRIORITY.get(os.path.splitext(path)[1], 1.0)
+    for pattern, factor in _NAME_PRIORITY_RULES:
+        if pattern.search(path):
+            score *= factor
+    score /= 1 + 0.15 * path.count('/')
+    if stat.st_size > _LARGE_FILE_BYTES:
+        score *= _LARGE_FILE_BYTES / stat.st_size
+    age = max(0.0, now - stat.st_mtime)
+    score *= 1 + 0.25 * 0.5 ** (age / _RECENCY_HALF_LIFE_S)
+    return score
+
+def pack_files(collected_files, budget, start_dir, chars_per_token=None, now=None):
+    """ 
+    Returns the files of collected_files that fit in a budget of estimated
+    tokens, chosen greedily by score_file and kept in collection order.
+    Only stat metadata is used: the cost of a file is estimated from its
+    size on disk plus its path header, so files that are not selected are
+    never opened. Comments and imports are stripped later, so the packed
+    output is usually below the budget.
+    """
+    start = os.fspath(Path(start_dir).resolve())
+    now = time.time() if now is None else now
+    candidates = []
+    for order, file_path in enumerate(collected_files):
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            continue
+        full_path = os.fspath(file_path)
+        rel_path = os.path.relpath(full_path, start).replace(os.sep, '/')
+        # Header ("\n\n{path}\n\n") plus the unprocessed contents
+        characters = len(full_path) + 4 + stat.st_size
+        cost = int(-(-characters // chars_per_token_ratio(file_path.suffix, chars_per_token)))
+        candidates.append((score_file(rel_path, stat, now), order, cost, file_path))
+    candidates.sort(key=lambda candidate: (-candidate[0], candidate[1]))
+    selected = []
+    remaining = budget
+    for score, order, cost, file_path in candidates:
+        if cost <= remaining:
+            selected.append((order, file_path))
+            remaining -= cost
+    selected.sort()
+    return [file_path for order, file_path in selected]
+
+# ----------------------------------------------------------------------------
+# Sharded output
+# ----------------------------------------------------------------------------
+def _utf8_size(text):
+    return len(text) if text.isascii() else len(text.encode('utf-8'))
+
+def shard_file_name(output_file, number):
+    """ 
+    Returns the name of shard number for output_file: codebase.prompt becomes
+    codebase.001.prompt, and a compression suffix stays last
+    (codebase.prompt.gz becomes codebase.001.prompt.gz).
+    """
+    directory, stem, tail = _shard_name_parts(output_file)
+    return os.fspath(directory / f"{stem}.{number:03d}{tail}")
+
+def _shard_name_parts(output_file):
+    """ 
+    Splits output_file into (directory, stem, tail) so that shard n is named
+    f"{stem}.{n:03d}{tail}" in directory.
+    """
+    path = Path(output_file)
+    compression_suffix = ''
+    if path.suffix.lower() in COMPRESSION_BY_SUFFIX:
+        compression_suffix = path.suffix
+        path = path.with_suffix('')
+    return path.parent, path.stem, path.suffix + compression_suffix
+
+def remove_stale_shards(output_file, shard_files):
+    """ 
+    Deletes the shards listed in the previous shard index of output_file
+    that are not among shard_files, the shards of this run. Only files an
+    earlier run recorded are touched; without a readable index nothing is.
+    """
+    index_file = shard_index_file_name(output_file)
+    try:
+        with open(index_file, 'r', encoding='utf-8') as f:
+            previous = [shard['file'] for shard in json.load(f)['shards']]
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print(f"Warning: Could not read previous shard index {index_file}: {e}", file=sys.stderr)
+        return
+    directory = Path(index_file).parent
+    current = {Path(name).name for name in shard_files}
+    for name in previous:
+        # Shards are written next to the index, whatever the earlier cwd
+        name = Path(name).name
+        if name in current:
+            continue
+        try:
+            os.remove(directory / name)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"Warning: Could not remove stale shard {directory / name}: {e}", file=sys.stderr)
+
+def shard_index_file_name(output_file):
+    """ 
+    Returns the name of the shard index for output_file: codebase.prompt
+    becomes codebase.index.json.
+    """
+    path = Path(output_file)
+    if path.suffix.lower() in COMPRESSION_BY_SUFFIX:
+        path = path.with_suffix('')
+    return os.fspath(path.with_name(f"{path.stem}.index.json"))
+
+class ShardWriter:
+    """ 
+    Writes sections to a series of shards (see shard_file_name), each at
+    most max_bytes UTF-8 bytes and max_tokens estimated tokens. A section
+    that does not fit in the current shard starts the next one; only a
+    section larger than a whole shard is split, at line boundaries where
+    possible. One shard is open at a time, and on close the shard index
+    (see shard_index_file_name) lists every shard with its size, token
+    estimate and files, and shards the previous index lists that this run
+    did not write are deleted. If the run fails, the open shard is closed
+    but the previous index and shards are left as they were.
+    """
+    def __init__(self, output_file, max_bytes=None, max_tokens=None, compression=None, compress_level=None,
+                 chars_per_token=None):
+        self.output_file = output_file
+        self.max_bytes = max_bytes
+        self.max_tokens = max_tokens
+        self.chars_per_token = CHARS_PER_TOKEN if chars_per_token is None else chars_per_token
+        self.compression = compression
+        self.compress_level = compress_level
+        self.shards = []
+        self.outfile = None
+
+    def _within(self, size, tokens):
+        return ((self.max_bytes is None or size <= self.max_bytes)
+                and (self.max_tokens is None or tokens <= self.max_tokens))
+
+    def _fits(self, size, tokens):
+        shard = self.shards[-1]
+        return self._within(shard['bytes'] + size, shard['tokens'] + tokens)
+
+    def _next_shard(self):
+        if self.outfile is not None:
+            self.outfile.close()
+        name = shard_file_name(self.output_file, len(self.shards) + 1)
+        self.outfile = open_output(name, self.compression, self.compress_level)
+        self.shards.append({'file': name, 'bytes': 0, 'tokens': 0, 'files': []})
+
+    def _write(self, file_path, text, size, tokens):
+        shard = self.shards[-1]
+        self.outfile.write(text)
+        shard['bytes'] += size
+        shard['tokens'] += tokens
+        if file_path is not None and (not shard['files'] or shard['files'][-1] != file_path):
+            shard['files'].append(file_path)
+
+    def _pieces(self, text, file_extension):
+        """ 
+        Splits an oversized section into pieces that each fit in an empty
+        shard: whole lines where possible, hard cuts for longer lines.
+        """
+        ratio = chars_per_token_ratio(file_extension, self.chars_per_token)
+        # A cut of this many characters fits both limits whatever its encoding
+        cut = min(limit for limit in (self.max_bytes and max(1, self.max_bytes // 4),
+                                      self.max_tokens and max(1, int(self.max_tokens * ratio))) if limit)
+        piece = []
+        piece_size = piece_tokens = 0
+        for line in text.splitlines(keepends=True):
+            size, tokens = _utf8_size(line), estimate_tokens(line, file_extension, self.chars_per_token)
+            if piece and not self._within(piece_size + size, piece_tokens + tokens):
+                yield ''.join(piece)
+                piece = []
+                piece_size = piece_tokens = 0
+            if not self._within(size, tokens):
+                for start in range(0, len(line), cut):
+                    yield line[start:start + cut]
+                continue
+            piece.append(line)
+            piece_size += size
+            piece_tokens += tokens
+        if piece:
+            yield ''.join(piece)
+
+    def write_section(self, file_path, section):
+        file_extension = '' if file_path is None else Path(file_path).suffix
+        file_path = None if file_path is None else os.fspath(file_path)
+        size, tokens = _utf8_size(section), estimate_tokens(section, file_extension, self.chars_per_token)
+        if not self.shards:
+            self._next_shard()
+        elif not self._fits(size, tokens):
+            if self.shards[-1]['bytes']:
+                self._next_shard()
+        if self._fits(size, tokens):
+            self._write(file_path, section, size, tokens)
+            return
+        # Larger than a whole shard
+        for piece in self._pieces(section, file_extension):
+            piece_size, piece_tokens = _utf8_size(piece), estimate_tokens(piece, file_extension, self.chars_per_token)
+            if self.shards[-1]['bytes'] and not self._fits(piece_size, piece_tokens):
+                self._next_shard()
+            self._write(file_path, piece, piece_size, piece_tokens)
+
+    def close(self):
+        if not self.shards:
+            self._next_shard()
+        self.outfile.close()
+        remove_stale_shards(self.output_file, [shard['file'] for shard in self.shards])
+        index = {
+            'max_bytes': self.max_bytes,
+            'max_tokens': self.max_tokens,
+            'shards': self.shards,
+        }
+        with open(shard_index_file_name(self.output_file), 'w', encoding='utf-8') as f:
+            json.dump(index, f, indent=2)
+            f.write('\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self.outfile is not None:
+            # An index for a truncated shard set would pass for a complete one
+            self.outfile.close()
+
+# ----------------------------------------------------------------------------
+# Watch mode
+# ----------------------------------------------------------------------------
+_IN_MODIFY = 0x00000002
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_MOVE_SELF = 0x00000800
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ISDIR = 0x40000000
+_IN_STRUCTURE = _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE | _IN_DELETE_SELF | _IN_MOVE_SELF
+_INOTIFY_EVENT = struct.Struct('iIII')
+
+class _InotifyWatcher:
+    """ 
+    Watches directories with Linux inotify through ctypes. wait() returns
+    (changed_paths, structural): the files whose contents changed, and
+    whether the file list must be collected again. Editors often save by
+    renaming (vim's backups, "safe write" in JetBrains IDEs), so a collected
+    file that is removed and created again within one burst, or a file
+    created or moved over a collected one, is only a content change; only
+    collected files that disappear, new files with a collected extension,
+    directory changes and .gitignore edits are structural. The collected
+    files are given with track_files. After an event queue overflow
+    changed_paths is None: anything may have changed.
+    """
+
+    def __init__(self, extensions):
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.get_errno = ctypes.get_errno
+        self.extensions = extensions
+        self.watches = {}
+        self.watched_dirs = set()
+        self.files = set()
+
+    def add_dirs(self, dirs):
+        mask = _IN_MODIFY | _IN_CLOSE_WRITE | _IN_STRUCTURE
+        for directory in dirs:
+            if directory in self.watched_dirs:
+                continue
+            wd = self._add_watch(self.fd, os.fsencode(directory), mask)
+            if wd < 0:
+                error = self.get_errno()
+                if error == errno.ENOSPC:
+                    # Unwatched directories would never trigger regeneration
+                    raise OSError(error, "inotify watch limit reached (see fs.inotify.max_user_watches)")
+                if error != errno.ENOENT:
+                    print(f"Warning: Could not watch {directory}: {os.strerror(error)}", file=sys.stderr)
+                continue
+            self.watches[wd] = directory
+            self.watched_dirs.add(directory)
+
+    def track_files(self, files):
+        self.files = {os.fspath(f) for f in files}
+
+    def wait(self, timeout=None, debounce=0.05):
+        changed = set()
+        # Whether each created or removed file exists after the burst
+        exists = {}
+        structural = False
+        overflow = False
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        while ready:
+            data = os.read(self.fd, 1 << 16)
+            offset = 0
+            while offset < len(data):
+                wd, mask, _cookie, length = _INOTIFY_EVENT.unpack_from(data, offset)
+                offset += _INOTIFY_EVENT.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+                if mask & _IN_Q_OVERFLOW:
+                    structural = overflow = True
+                    continue
+                if mask & _IN_IGNORED:
+                    directory = self.watches.pop(wd, None)
+                    self.watched_dirs.discard(directory)
+                    continue
+                directory = self.watches.get(wd)
+                if directory is None:
+                    continue
+                if name == '.gitignore' or mask & (_IN_DELETE_SELF | _IN_MOVE_SELF):
+                    structural = True
+                elif mask & _IN_STRUCTURE:
+                    if mask & _IN_ISDIR:
+                        structural = True
+                    elif name.lower().endswith(self.extensions):
+                        # Files that could never be collected (such as the
+                        # output file itself) leave the list unchanged
+                        path = os.path.join(directory, name)
+                        exists[path] = bool(mask & (_IN_MOVED_TO | _IN_CREATE))
+                        if exists[path]:
+                            changed.add(path)
+                elif name and not mask & _IN_ISDIR:
+                    changed.add(os.path.join(directory, name))
+            # Gather the rest of a burst (editors often write several times)
+            ready, _, _ = select.select([self.fd], [], [], debounce)
+        if any(present != (path in self.files) for path, present in exists.items()):
+            structural = True
+        return (None if overflow else changed), structural
+
+    def close(self):
+        os.close(self.fd)
+
+class _PollingWatcher:
+    """ 
+    Fallback watcher that compares stat signatures of the watched
+    directories and collected files every interval seconds.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.dir_stats = {}
+        self.file_stats = {}
+
+    def add_dirs(self, dirs):
+        self.dir_stats = {d: _stat_signature(d) for d in dirs}
+
+    def track_files(self, files):
+        self.file_stats = {os.fspath(f): _stat_signature(f) for f in files}
+
+    def wait(self, timeout=None):
+        time.sleep(self.interval)
+        structural = any(_stat_signature(d) != st for d, st in self.dir_stats.items())
+        changed = set()
+        for path, st in self.file_stats.items():
+            current = _stat_signature(path)
+            if current != st:
+                self.file_stats[path] = current
+                changed.add(path)
+        return changed, structural
+
+    def close(self):
+        pass
+
+def watch_output(collect, output_file, extensions, poll_interval=0.5, use_inotify=True, line_filters=None,
+                 strip_docstrings=False, compression=None, compress_level=None):
+    """ 
+    Writes the output, then keeps running and regenerates it whenever the
+    tree changes. collect(visited_dirs) returns the file list and appends the
+    directories it walked to visited_dirs. Rendered sections are kept per
+    file, so a content change re-processes only that file, also when an
+    editor saves by renaming a new file over the old one; new or removed
+    files re-run collect (cheap with the traversal cache) and only new files
+    are processed. If inotify runs out of watches, it falls back to polling.
+    compression and compress_level are passed to open_output.
+    """
+    watcher = None
+    if use_inotify and sys.platform.startswith('linux'):
+        try:
+            watcher = _InotifyWatcher(extensions)
+        except (OSError, AttributeError) as e:
+            print(f"Warning: inotify unavailable ({e}); polling every {poll_interval}s instead.", file=sys.stderr)
+    if watcher is None:
+        watcher = _PollingWatcher(poll_interval)
+    sections = {}
+
+    def regenerate(files, dirty):
+        for file_path in files:
+            key = os.fspath(file_path)
+            if key in dirty or key not in sections:
+                sections[key] = render_file_section(file_path, line_filters, strip_docstrings)
+        with open_output(output_file, compression, compress_level) as outfile:
+            if files:
+                outfile.write(''.join(sections[os.fspath(f)] for f in files))
+            else:
+                outfile.write(NO_FILES_FOUND)
+        for key in set(sections) - {os.fspath(f) for f in files}:
+            del sections[key]
+
+    def refresh_file_list():
+        nonlocal watcher
+        visited = []
+        files = collect(visited)
+        try:
+            watcher.add_dirs(visited)
+        except OSError as e:
+            print(f"Warning: {e.strerror}; polling every {poll_interval}s instead.", file=sys.stderr)
+            watcher.close()
+            watcher = _PollingWatcher(poll_interval)
+            watcher.add_dirs(visited)
+        watcher.track_files(files)
+        return files
+
+    files = refresh_file_list()
+    regenerate(files, set())
+    print(f"Watching {len(files)} files; '{output_file}' is regenerated on change. Press Ctrl+C to stop.")
+    try:
+        while True:
+            changed, structural = watcher.wait()
+            if changed is None:
+                changed = set(sections)
+            changed.intersection_update(sections)
+            if not changed and not structural:
+                continue
+            started = time.perf_counter()
+            if structural:
+                files = refresh_file_list()
+            regenerate(files, changed)
+            elapsed = time.perf_counter() - started
+            print(f"Regenerated '{output_file}' ({len(files)} files) in {elapsed * 1000:.0f} ms")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
 
 def parse_arguments():
     parser = argparse.ArgumentParser(
@@ -249,7 +2282,70 @@ def parse_arguments():
     parser.add_argument(
         '-o', '--output',
         default='codebase.prompt',
-        help='Name of the output file (default: codebase.prompt)'
+        help="Name of the output file, or '-' to stream to stdout (default: codebase.prompt)"
+    )
+    parser.add_argument(
+        '--compress',
+        choices=['gzip', 'bz2', 'xz', 'none'],
+        help=("Compress the output while it is written (default: inferred from the output "
+              "suffix: .gz, .bz2 or .xz; otherwise none)")
+    )
+    parser.add_argument(
+        '--compress-level',
+        type=int,
+        metavar='LEVEL',
+        help="Compression level: 1-9 for gzip and bz2, 0-9 for xz (default: 9 for gzip and bz2, 6 for xz)"
+    )
+    parser.add_argument(
+        '--max-tokens',
+        type=int,
+        metavar='N',
+        help=("Split the output into shards (codebase.001.prompt, ...) of at most N estimated "
+              "tokens each, plus a codebase.index.json shard index")
+    )
+    parser.add_argument(
+        '--max-bytes',
+        type=int,
+        metavar='N',
+        help="Split the output into shards of at most N bytes each (combines with --max-tokens)"
+    )
+    parser.add_argument(
+        '--stats',
+        nargs='?',
+        const='',
+        metavar='FILE',
+        help=("Write estimated per-file and total token counts to a JSON sidecar (default FILE: "
+              "the output name with .stats.json, e.g. codebase.stats.json)")
+    )
+    parser.add_argument(
+        '--token-calibration',
+        metavar='FILE',
+        help=("JSON object of characters per token by extension (and '*' for the rest) for the "
+              "token estimator; see benchmarks/calibrate_tokens.py")
+    )
+    parser.add_argument(
+        '--budget',
+        type=int,
+        metavar='TOKENS',
+        help=("Keep only the most valuable files that fit in TOKENS estimated tokens, ranked by "
+              "extension, name, depth, size and modification time; files left out are never read")
+    )
+    parser.add_argument(
+        '--dedupe',
+        action='store_true',
+        help=("Write files with byte-identical contents only once; later copies get a one-line "
+              "reference to the first and are not processed")
+    )
+    parser.add_argument(
+        '--near-dupes',
+        nargs='?',
+        type=float,
+        const=0.85,
+        metavar='THRESHOLD',
+        help=("Collapse files whose processed text is at least THRESHOLD similar (estimated Jaccard "
+              "similarity of token shingles, default 0.85) to an earlier file into a reference "
+              "plus a diff; uses NumPy if installed, the pure-Python fallback is slower on "
+              "large trees")
     )
     parser.add_argument(
         '-x', '--exclude',
@@ -257,22 +2353,192 @@ def parse_arguments():
         default=['build', 'venv'],
         help='List of directory names to exclude (default: build venv)'
     )
+    parser.add_argument(
+        '--drop-line',
+        action='append',
+        default=[],
+        metavar='REGEX',
+        help='Also drop every line matching REGEX, in all file types (can be given several times)'
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=1,
+        metavar='N',
+        help='Process files in N worker processes; 0 uses every CPU (default: 1)'
+    )
+    parser.add_argument(
+        '--read-ahead',
+        type=int,
+        default=0,
+        metavar='DEPTH',
+        help=("Read up to DEPTH files ahead of processing with a thread pool, for network or slow "
+              "filesystems; used when --jobs is 1 (default: 0, off)")
+    )
+    parser.add_argument(
+        '--io-threads',
+        type=int,
+        default=8,
+        metavar='N',
+        help='Threads reading files for --read-ahead (default: 8)'
+    )
+    parser.add_argument(
+        '--strip-docstrings',
+        action='store_true',
+        help='Also remove module, class and function docstrings from Python files'
+    )
+    parser.add_argument(
+        '--source',
+        choices=['walk', 'index', 'git'],
+        default='walk',
+        help=("How to enumerate files: 'walk' traverses the filesystem, 'index' reads tracked "
+              "files only from .git/index, 'git' streams 'git ls-files'. Both git sources fall back "
+              "to walking outside a git repository (default: walk)")
+    )
+    parser.add_argument(
+        '--untracked',
+        action='store_true',
+        help=("With --source index, also walk the tree for untracked files that are not ignored "
+              "(slower; --source git lists them without a walk)")
+    )
+    parser.add_argument(
+        '--sort',
+        action='store_true',
+        help=("With --source walk, visit the entries of every directory in name order for a "
+              "stable output order; git sources are already in path order")
+    )
+    parser.add_argument(
+        '--watch',
+        action='store_true',
+        help=("Keep running and regenerate the output when files change, re-processing only "
+              "changed files (uses inotify on Linux, polling elsewhere)")
+    )
+    parser.add_argument(
+        '--poll-interval',
+        type=float,
+        default=0.5,
+        metavar='SECONDS',
+        help='Polling interval for --watch when inotify is unavailable (default: 0.5)'
+    )
+    parser.add_argument(
+        '--cache',
+        nargs='?',
+        const='',
+        default=None,
+        metavar='FILE',
+        help=("Reuse a directory-mtime traversal cache between runs of the filesystem walk "
+              "(default file: ~/.cache/codecollector/<hash of start_dir>.json)")
+    )
     return parser.parse_args()
 
 def main():
     args = parse_arguments()
     extensions = tuple(ext if ext.startswith('.') else f'.{ext}' for ext in args.extensions)
     exclude_dirs = set(args.exclude)
-    # Collect all .gitignore patterns
-    ignore_spec = collect_gitignore_patterns(args.start_dir)
-    # Collect the files to be consolidated
-    collected_files = collect_files(args.start_dir, extensions, exclude_dirs, ignore_spec)
-    # Write the consolidated output
-    write_output(collected_files, args.output)
-    if collected_files:
-        print(f"Consolidated {len(collected_files)} files into '{args.output}', excluding import statements, comments, and certain lines.")
+    try:
+        line_filters = compile_line_filters(args.drop_line)
+    except re.error as e:
+        raise SystemExit(f"Error: invalid --drop-line regex: {e}")
+    cache_file = None
+    if args.cache is not None:
+        cache_file = args.cache or default_cache_file(args.start_dir)
+
+    def collect(visited_dirs=None, lazy=False):
+        if args.source == 'index':
+            files = collect_files_from_git_index(
+                args.start_dir, extensions, exclude_dirs, include_untracked=args.untracked)
+        elif args.source == 'git':
+            files = collect_files_from_git_ls_files(args.start_dir, extensions, exclude_dirs)
+        else:
+            # Reads .gitignore files on the way
+            files = iter_files(args.start_dir, extensions, exclude_dirs, cache_file=cache_file,
+                               visited_dirs=visited_dirs, sort=args.sort)
+            return files if lazy else list(files)
+        if visited_dirs is not None:
+            visited_dirs.extend(dict.fromkeys([os.fspath(Path(args.start_dir).resolve())]
+                                              + [os.fspath(f.parent) for f in files]))
+        return files
+
+    compression = args.compress or infer_compression(args.output)
+    if compression == 'none':
+        compression = None
+    if compression and args.compress_level is not None:
+        lowest = 0 if compression == 'xz' else 1
+        if not lowest <= args.compress_level <= 9:
+            raise SystemExit(f"Error: --compress-level for {compression} must be between {lowest} and 9")
+    if args.watch:
+        if args.output == STDOUT:
+            raise SystemExit("Error: --watch needs an output file, not stdout")
+        unsupported = [flag for flag, used in (
+            ('--jobs', args.jobs != 1), ('--read-ahead', args.read_ahead > 0),
+            ('--max-tokens', args.max_tokens is not None), ('--max-bytes', args.max_bytes is not None),
+            ('--stats', args.stats is not None), ('--budget', args.budget is not None),
+            ('--dedupe', args.dedupe), ('--near-dupes', args.near_dupes is not None)) if used]
+        if unsupported:
+            raise SystemExit(f"Error: {', '.join(unsupported)} cannot be combined with --watch")
+        watch_output(collect, args.output, extensions, poll_interval=args.poll_interval,
+                     line_filters=line_filters, strip_docstrings=args.strip_docstrings,
+                     compression=compression, compress_level=args.compress_level)
+        return
+    # Files are consolidated as they are collected
+    collected_files = collect(lazy=True)
+    jobs = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+    chars_per_token = None
+    if args.token_calibration:
+        try:
+            chars_per_token = load_token_calibration(args.token_calibration)
+        except (OSError, ValueError) as e:
+            raise SystemExit(f"Error: invalid --token-calibration file {args.token_calibration}: {e}")
+    stats_file = None
+    if args.stats is not None:
+        stats_file = args.stats or default_stats_file(args.output)
+    sharded = args.max_tokens is not None or args.max_bytes is not None
+    if sharded:
+        if args.output == STDOUT:
+            raise SystemExit("Error: --max-tokens/--max-bytes need an output file, not stdout")
+        if (args.max_tokens is not None and args.max_tokens < 1) or (args.max_bytes is not None and args.max_bytes < 1):
+            raise SystemExit("Error: --max-tokens and --max-bytes must be positive")
+    if args.near_dupes is not None and not 0 < args.near_dupes <= 1:
+        raise SystemExit("Error: --near-dupes threshold must be in (0, 1]")
+    if args.near_dupes is not None and numpy is None:
+        print("Warning: NumPy is not installed; --near-dupes uses the slower pure-Python "
+              "signatures (pip install codecollector[numpy])", file=sys.stderr)
+    # Keep stdout clean when the output itself is streamed there
+    status = sys.stderr if args.output == STDOUT else sys.stdout
+    if args.budget is not None:
+        if args.budget < 1:
+            raise SystemExit("Error: --budget must be positive")
+        collected_files = list(collected_files)
+        total = len(collected_files)
+        collected_files = pack_files(collected_files, args.budget, args.start_dir, chars_per_token)
+        print(f"Packed {len(collected_files)} of {total} files into a budget of {args.budget} tokens.",
+              file=status)
+    try:
+        count = write_output(collected_files, args.output, line_filters=line_filters,
+                             strip_docstrings=args.strip_docstrings, jobs=jobs,
+                             read_ahead=args.read_ahead, io_threads=args.io_threads,
+                             compression=compression, compress_level=args.compress_level,
+                             max_bytes=args.max_bytes, max_tokens=args.max_tokens,
+                             stats_file=stats_file, chars_per_token=chars_per_token, dedupe=args.dedupe,
+                             near_duplicates=args.near_dupes)
+    except BrokenPipeError:
+        # The consumer stopped reading (e.g. `| head`); silence the flush at exit
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        raise SystemExit(1)
+
+    if args.output == STDOUT:
+        destination = 'stdout'
+    elif sharded:
+        destination = f"shards listed in '{shard_index_file_name(args.output)}'"
+    else:
+        destination = f"'{args.output}'"
+    if count:
+        print(f"Consolidated {count} files into {destination}, excluding import statements, comments, and certain lines.",
+              file=status)
     else:
-        print("No files found with the specified extensions.")
+        print("No files found with the specified extensions.", file=status)
+    if stats_file:
+        print(f"Wrote estimated token counts to '{stats_file}'.", file=status)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1 @@
+# Lets a bare `pytest` import the codecollector package from the checkout.
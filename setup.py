@@ -10,6 +10,10 @@ setup(
     long_description_content_type='text/markdown',
     url='https://github.com/emergentcomplex/codecollector',
     packages=find_packages(),
+    extras_require={
+        # Vectorised MinHash signatures for --near-dupes
+        'numpy': ['numpy'],
+    },
     entry_points={
         'console_scripts': [
             'codecollector=codecollector.codecollector:main',
@@ -19,5 +23,5 @@ setup(
         'Programming Language :: Python :: 3',
         'Operating System :: OS Independent',
     ],
-    python_requires='>=3.6',
+    python_requires='>=3.7',
 )
@@ -0,0 +1,114 @@
+"""
+Differential tests of CompiledIgnoreRules and ScopedIgnoreMatcher against
+pathspec's matching with the same gitignore pattern class.
+"""
+import random
+
+import pathspec
+import pytest
+
+from codecollector.codecollector import CompiledIgnoreRules, GitIgnorePattern, ScopedIgnoreMatcher
+
+NAMES = ['foo', 'bar', 'build', 'node_modules', '.env', 'a.b', 'x', 'Foo', 'dist', 'main.py', 'app.min.js']
+EXTS = ['py', 'js', 'log', 'min.js', 'tar.gz', 'b', '']
+PATTERN_SHAPES = [
+    lambda r: r.choice(NAMES),
+    lambda r: r.choice(NAMES) + '/',
+    lambda r: '*.' + r.choice(EXTS),
+    lambda r: '*.' + r.choice(EXTS) + '/',
+    lambda r: '/' + r.choice(NAMES),
+    lambda r: r.choice(NAMES) + '/' + r.choice(NAMES),
+    lambda r: '**/' + r.choice(NAMES),
+    lambda r: r.choice(NAMES) + '/**',
+    lambda r: r.choice(NAMES) + '/**/' + r.choice(NAMES),
+    lambda r: r.choice(NAMES)[:2] + '*',
+    lambda r: '?' + r.choice(NAMES)[1:],
+    lambda r: '[fb]' + r.choice(NAMES)[1:],
+    lambda r: r.choice(NAMES) + ' ',
+    lambda r: '\\#' + r.choice(NAMES),
+    lambda r: '.',
+    lambda r: '*',
+    lambda r: '*/',
+    lambda r: '**/',
+    lambda r: '**/*/',
+    lambda r: '# comment',
+]
+
+
+def random_patterns(rng, count):
+    lines = []
+    for _ in range(count):
+        line = rng.choice(PATTERN_SHAPES)(rng)
+        if rng.random() < 0.25 and not line.startswith('#'):
+            line = '!' + line
+        lines.append(line)
+    return lines
+
+
+def random_path(rng):
+    parts = [rng.choice(NAMES + ['src', 'lib', 'f.' + rng.choice(EXTS)]) for _ in range(rng.randint(1, 5))]
+    path = '/'.join(parts)
+    return path + '/' if rng.random() < 0.3 else path
+
+
+def mismatches(lines, paths):
+    spec = pathspec.PathSpec.from_lines(GitIgnorePattern, lines)
+    rules = CompiledIgnoreRules(lines)
+    return [path for path in paths if spec.match_file(path) != rules.match_file(path)]
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_random_pattern_sets_match_pathspec(seed):
+    rng = random.Random(seed)
+    for _ in range(10):
+        lines = random_patterns(rng, rng.choice([1, 5, 40]))
+        paths = [random_path(rng) for _ in range(100)]
+        assert mismatches(lines, paths) == [], lines
+
+
+@pytest.mark.parametrize('lines, path', [
+    (['*.log', '!keep.log'], 'logs/keep.log'),
+    (['!keep.log', '*.log'], 'logs/keep.log'),
+    (['build/'], 'src/build/'),
+    (['build/'], 'src/build'),
+    (['build/'], 'build/out.py'),
+    (['/build'], 'src/build/'),
+    (['*.min.js'], 'static/app.min.js'),
+    (['*.js', '!*.min.js'], 'static/app.min.js'),
+    (['*.py[cod]'], 'pkg/mod.pyc'),
+    (['docs/_build/'], 'docs/_build/'),
+    (['foo/**/bar'], 'foo/a/b/bar'),
+    (['\\#notes'], '#notes'),
+    (['.'], 'a/b'),
+    (['*/'], 'src/'),
+    (['**/'], 'src/pkg/'),
+    (['*', '!*/', '!*.py'], 'src/'),
+    (['*', '!*/', '!*.py'], 'src/pkg/b.py'),
+    (['*', '!*/', '!*.py'], 'src/pkg/b.txt'),
+])
+def test_fixed_cases_match_pathspec(lines, path):
+    assert mismatches(lines, [path]) == []
+
+
+def test_scoped_matcher_prefers_deeper_gitignore():
+    # Frames are pushed while descending, so each matcher only sees paths
+    # below the folders of its frames
+    root = ScopedIgnoreMatcher().child('', ['*.log'])
+    sub = root.child('sub/', ['!keep.log'])
+    assert root.match_file('other/keep.log')
+    assert not sub.match_file('sub/keep.log')
+    assert sub.match_file('sub/drop.log')
+
+
+def test_scoped_matcher_matches_relative_to_its_folder():
+    root = ScopedIgnoreMatcher().child('', ['/out'])
+    sub = ScopedIgnoreMatcher().child('sub/', ['/out'])
+    assert root.match_file('out')
+    assert not root.match_file('sub/out')
+    assert sub.match_file('sub/out')
+    assert not sub.match_file('sub/deeper/out')
+
+
+def test_empty_gitignore_adds_no_frame():
+    root = ScopedIgnoreMatcher()
+    assert root.child('', ['# comment', '']) is root